@@ -1,4 +1,10 @@
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import os
+import sys
+import threading
+import time
 import requests
 import json
 import random
@@ -69,6 +75,33 @@ delete_account_query = """mutation LambdaDeleteAccount($session: String!) {
     }
     """
 
+login_query = """mutation LoadLogin($email: String!, $password: String!) {
+        login(email: $email, passwordInput: $password) {
+            ok
+            session
+        }
+    }
+    """
+
+account_query = """query LoadAccount($session: String!) {
+        account(session: $session) {
+            name
+            mealsMade
+            masteredSkills
+            skills { name progress }
+            accountFlags { completedOrientation verified }
+            menus { menuIndex recipes { recipeId recipeName } }
+        }
+    }
+    """
+
+complete_recipe_query = """mutation LoadCompleteRecipe($session: String!, $recipeId: Int!) {
+        completeRecipe(session: $session, recipeId: $recipeId) {
+            ok
+        }
+    }
+    """
+
 class Logger:
     def __init__(self):
         self.logs = []
@@ -224,5 +257,198 @@ def main():
         logger.print(f"Something failed when trying to access API at {date_string}")
         diagnostics = dict(time=date_string, status="Dead", cause=failureCause, logs=logger.get_all())
 
+# Upper bounds in milliseconds of the latency histogram buckets
+HISTOGRAM_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf')]
+DEFAULT_MIX = 'requestMenus=2,account=5,login=1,completeRecipe=2'
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.user_failures = []
+
+    def record(self, operation, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(seconds * 1000)
+            self.errors[operation] = self.errors.get(operation, 0) + (0 if ok else 1)
+
+    def record_user_failure(self, index, error):
+        with self.lock:
+            self.user_failures.append((index, error))
+
+    def report(self, elapsed):
+        lines = []
+        with self.lock:
+            operations = sorted(self.latencies)
+            total = sum(len(self.latencies[operation]) for operation in operations)
+            lines.append(f'Load test: {total} requests in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} req/s)')
+            for operation in operations:
+                latencies = sorted(self.latencies[operation])
+                errors = self.errors.get(operation, 0)
+                percentile = lambda fraction: latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+                lines.append(f'{operation}: {len(latencies)} requests, {errors} errors '
+                             f'({errors / len(latencies):.1%}), p50 {percentile(0.5):.1f}ms, '
+                             f'p90 {percentile(0.9):.1f}ms, p99 {percentile(0.99):.1f}ms, max {latencies[-1]:.1f}ms')
+                counts = [0] * len(HISTOGRAM_BUCKETS)
+                for latency in latencies:
+                    counts[next(i for i, bound in enumerate(HISTOGRAM_BUCKETS) if latency <= bound)] += 1
+                labels = [f'<={bound:g}ms' for bound in HISTOGRAM_BUCKETS[:-1]] + [f'>{HISTOGRAM_BUCKETS[-2]:g}ms']
+                lines.append(f'{operation} histogram: ' + ', '.join(
+                    f'{label}: {count}' for label, count in zip(labels, counts)))
+            if self.user_failures:
+                lines.append(f'{len(self.user_failures)} virtual user(s) failed')
+                for index, error in self.user_failures:
+                    lines.append(f'user {index}: {error}')
+        return lines
+
+
+credential_random = random.SystemRandom()
+
+
+class VirtualUser:
+    """One simulated client: creates an account, runs the operation mix until the deadline and deletes it."""
+
+    def __init__(self, index, stats, mix, deadline):
+        self.index = index
+        self.stats = stats
+        self.mix = mix
+        self.deadline = deadline
+        # One keep-alive connection pool per user, like a real client
+        self.client = requests.Session()
+        # Seeded so a run's operation mix is repeatable, credentials come from credential_random instead
+        self.random = random.Random(index)
+        self.email = None
+        self.password = None
+        self.session = None
+        self.recipe_ids = [1]
+
+    def call(self, operation, query, variables, check_ok=False):
+        """Post one operation and record it; with check_ok an answer whose ok field is false counts as an error."""
+        start = time.perf_counter()
+        data = None
+        try:
+            response = self.client.post(url=endpoint_url, json=dict(query=query, variables=variables), timeout=30)
+            if response.status_code == 200:
+                body = response.json()
+                if not body.get('errors'):
+                    data = body['data']
+        except (requests.RequestException, ValueError):
+            pass
+        ok = data is not None and (not check_ok or bool((data.get(operation) or {}).get('ok')))
+        self.stats.record(operation, time.perf_counter() - start, ok)
+        return data
+
+    def create_account(self):
+        letters = string.ascii_lowercase
+        # Unique per run, so accounts left behind by an earlier or concurrent run never collide with this one
+        self.email = f"{''.join(credential_random.choice(letters) for i in range(16))}@test_account.com"
+        self.password = ''.join(credential_random.choice(letters) for i in range(8)) + 'A1!'
+        variables = {"form": {"email": self.email, "name": f'load{self.index}', "passwordInput": self.password},
+                     "restrictions": ["vegetarian"] if self.random.random() < 0.3 else []}
+        data = self.call('createAccount', create_account_query, variables, check_ok=True)
+        if data is not None and data['createAccount']['ok']:
+            self.session = data['createAccount']['session']
+        return self.session is not None
+
+    def request_menus(self):
+        variables = dict(recipeCount=3, menuCount=2, session=self.session, override=self.random.random() < 0.5)
+        data = self.call('requestMenus', request_menus_query, variables)
+        if data is not None and data['requestMenus']['ok']:
+            recipe_ids = [recipe['recipeId'] for menu in data['requestMenus']['menus'] for recipe in menu['recipes']]
+            self.recipe_ids = recipe_ids or self.recipe_ids
+
+    def account(self):
+        self.call('account', account_query, dict(session=self.session))
+
+    def login(self):
+        data = self.call('login', login_query, dict(email=self.email, password=self.password))
+        if data is not None and data['login']['ok']:
+            self.session = data['login']['session']
+
+    def complete_recipe(self):
+        variables = dict(session=self.session, recipeId=self.random.choice(self.recipe_ids))
+        self.call('completeRecipe', complete_recipe_query, variables)
+
+    def delete_account(self):
+        self.call('deleteAccount', delete_account_query, dict(session=self.session))
+
+    def run(self, start_delay):
+        time.sleep(start_delay)
+        try:
+            if not self.create_account():
+                self.stats.record_user_failure(self.index, f'could not create the test account {self.email}')
+                return
+            operations = {'requestMenus': self.request_menus, 'account': self.account, 'login': self.login,
+                          'completeRecipe': self.complete_recipe}
+            names = list(self.mix)
+            weights = [self.mix[name] for name in names]
+            while time.time() < self.deadline:
+                operations[self.random.choices(names, weights)[0]]()
+        finally:
+            try:
+                # Clean up the test account even when an operation raised
+                if self.session is not None:
+                    self.delete_account()
+            finally:
+                self.client.close()
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in ('requestMenus', 'account', 'login', 'completeRecipe'):
+            raise ValueError(f'Unknown operation {name} in the mix')
+        weights[name] = float(weight)
+    return weights
+
+
+def log_path():
+    """The daily log the /logs/<year>/<month>/<day> route of graph.py serves."""
+    now = datetime.now()
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), now.strftime('%Y'), now.strftime('%m'))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{now.strftime("%d")}.log')
+
+
+def load_test(argv):
+    global endpoint_url
+    parser = argparse.ArgumentParser(description='Run concurrent virtual users against the GraphQL endpoint')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=60, help='Seconds each user keeps running after ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=10, help='Seconds over which the users are started')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Operation weights, e.g. account=5,login=1')
+    parser.add_argument('--endpoint', default=endpoint_url)
+    args = parser.parse_args(argv)
+    endpoint_url = args.endpoint
+
+    mix = parse_mix(args.mix)
+    start = time.time()
+    deadline = start + args.ramp_up + args.duration
+    stats = LoadStats()
+    logger.print(f'Starting load test with {args.users} users ({args.ramp_up}s ramp-up, {args.duration}s) '
+                 f'against {endpoint_url}, mix {args.mix}')
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        futures = {}
+        for index in range(args.users):
+            user = VirtualUser(index, stats, mix, deadline)
+            futures[executor.submit(user.run, index * args.ramp_up / max(args.users, 1))] = index
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                stats.record_user_failure(futures[future], repr(e))
+
+    for line in stats.report(time.time() - start):
+        logger.print(line)
+    with open(log_path(), 'a') as file:
+        file.write('\n'.join(logger.logs) + '\n')
+
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'load':
+        load_test(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,188 @@
+#!venv/bin/python
+import asyncio
+import contextvars
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qsl
+
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from graphql_server import HttpQueryError, encode_execution_results, json_encode, load_json_body, run_http_query
+from promise import Promise, is_thenable
+
+import database
+import graph
+import log
+import metrics
+import persisted_queries
+import query
+from graph import app as flask_app
+from response_cache import cacheable_results, responses
+
+"""
+ASGI entry point serving /graphql, run with `uvicorn asgi:app` (or ./asgi.py [port]).
+
+query.schema is executed by graphql-core's AsyncioExecutor on the event loop, so one worker multiplexes hundreds of
+requests in flight.  The fields in query.ASYNC_RESOLVERS (Query.account, the Account fields and Recipe.tags) are
+resolved by coroutines on the asyncio Neo4j driver, which means sibling fields such as menus, skills and accountFlags
+await their statements concurrently instead of being composed into one.  The remaining root fields (every mutation,
+presignObject, ...) still have synchronous resolvers that use the request's session on flask's g and block on S3 or
+Neo4j; each one runs on a pool of GRAPHQL_WORKERS threads inside its own Flask app context, so they never block the
+loop.  Nested fields outside ASYNC_RESOLVERS only read what their parent resolved and run on the loop directly.
+
+File uploads (multipart requests) and the other routes stay on graph.py.
+"""
+
+GRAPHQL_WORKERS = int(os.getenv('GRAPHQL_WORKERS', 32))
+
+log.configure()
+
+thread_pool = ThreadPoolExecutor(max_workers=GRAPHQL_WORKERS, thread_name_prefix='graphql')
+middleware = metrics.MetricsMiddleware()
+
+
+class RequestContext():
+    """info.context for one request, holding what graph.py keeps on flask's g."""
+
+    def __init__(self):
+        self.recipe_tag_loader = query.AsyncRecipeTagLoader()
+
+
+def run_in_app_context(resolve, root, info, args):
+    with flask_app.app_context():
+        return resolve(root, info, **args)
+
+
+class AsyncResolverMiddleware():
+    """Swaps in the coroutine resolvers from query.ASYNC_RESOLVERS and moves synchronous root fields off the loop."""
+
+    def resolve(self, next, root, info, **args):
+        async_resolver = query.ASYNC_RESOLVERS.get(f'{info.parent_type.name}.{info.field_name}')
+        if async_resolver is not None:
+            # A task rather than a bare coroutine, so MetricsMiddleware times it until it finishes
+            return asyncio.ensure_future(async_resolver(root, info, **args))
+        if info.parent_type in (info.schema.get_query_type(), info.schema.get_mutation_type()):
+            loop = asyncio.get_running_loop()
+            # Carry the request's metrics over to the worker thread
+            run = partial(contextvars.copy_context().run, run_in_app_context, next, root, info, args)
+            return loop.run_in_executor(thread_pool, run)
+        return next(root, info, **args)
+
+
+async def settle(result):
+    """Wait for an execution result that may still be a promise resolving on the event loop."""
+    if not is_thenable(result):
+        return result
+    future = asyncio.get_running_loop().create_future()
+    Promise.resolve(result).then(future.set_result, future.set_exception)
+    return await future
+
+
+def encode(data):
+    return json_encode(metrics.with_tracing(data))
+
+
+async def execute(request_method, data, query_data):
+    """Run one GraphQL request the way FileUploadGraphQLView does, returning (body, status)."""
+    with metrics.collect() as request_metrics:
+        try:
+            data = persisted_queries.resolve_request(data, query_data)
+            plan = responses.plan(query.schema, data, query_data)
+            if plan is not None:
+                body = responses.get(plan.key)
+                if body is not None:
+                    return body, 200
+
+            execution_results, _ = run_http_query(query.schema, request_method, data, query_data=query_data,
+                                                  batch_enabled=False, catch=False, backend=persisted_queries.backend,
+                                                  middleware=[AsyncResolverMiddleware(), middleware],
+                                                  executor=AsyncioExecutor(asyncio.get_running_loop()),
+                                                  return_promise=True, context_value=RequestContext())
+            execution_results = [await settle(result) for result in execution_results]
+            body, status = encode_execution_results(execution_results, is_batch=isinstance(data, list),
+                                                    encode=encode)
+            if plan is not None and not request_metrics.tracing and status == 200 \
+                    and cacheable_results(execution_results):
+                responses.put(plan, body)
+            return body, status
+        except HttpQueryError as e:
+            return json_encode({'errors': [{'message': e.message}]}), e.status_code
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def send_response(send, status, body, content_type=b'application/json'):
+    body = body.encode('utf-8') if isinstance(body, str) else body
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await loop.run_in_executor(thread_pool, graph.startup)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Let in-flight resolvers finish without holding up the loop
+            await loop.run_in_executor(None, thread_pool.shutdown)
+            await database.close_async_graph_db()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app_asgi(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] == '/':
+        await send_response(send, 200, 'The server is up', content_type=b'text/plain')
+        return
+    if scope['path'] != '/graphql' or scope['method'] not in ('GET', 'POST'):
+        await send_response(send, 404, json_encode({'errors': [{'message': 'Not found'}]}))
+        return
+
+    query_data = dict(parse_qsl(scope.get('query_string', b'').decode('utf-8')))
+    data = {}
+    if scope['method'] == 'POST':
+        headers = dict(scope['headers'])
+        content_type = headers.get(b'content-type', b'').decode('latin-1').split(';')[0].strip()
+        body = await read_body(receive)
+        if content_type == 'application/graphql':
+            data = {'query': body.decode('utf-8')}
+        elif content_type == 'application/json':
+            try:
+                data = load_json_body(body.decode('utf-8'))
+            except HttpQueryError as e:
+                await send_response(send, e.status_code, json_encode({'errors': [{'message': e.message}]}))
+                return
+        else:
+            message = f'Unsupported content type {content_type}, uploads are served by graph.py'
+            await send_response(send, 415, json_encode({'errors': [{'message': message}]}))
+            return
+
+    body, status = await execute(scope['method'].lower(), data, query_data)
+    await send_response(send, status, body)
+
+
+# uvicorn looks up the module level name app
+app = app_asgi
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    uvicorn.run('asgi:app', host='0.0.0.0', port=port)
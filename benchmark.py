@@ -0,0 +1,227 @@
+#!venv/bin/python
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from itertools import cycle
+from typing import Callable, Dict, List, NamedTuple
+
+from flask import Flask, g
+
+# Keep per request logging out of the report (and the timings) unless asked for
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import database
+from fake_graph import FakeGraph
+
+"""
+Benchmark query.schema against FakeGraph, an in-memory stand-in for Neo4j seeded from recipes/*.json.
+
+Every scenario executes one representative document the way /graphql does (inside a Flask app context, through the
+cached document backend) and reports throughput, latency percentiles and Cypher statements per operation:
+
+    ./benchmark.py                      run and compare against benchmark_baseline.json when it exists
+    ./benchmark.py --save-baseline      run and record the results as the new baseline
+    ./benchmark.py --scenario account   run a single scenario
+
+Comparing fails (exit status 1) when a scenario runs more statements per operation than its baseline, or its
+throughput drops by more than --tolerance.  Timings depend on the machine, so record the baseline on the machine
+that runs the comparison.
+"""
+
+BASELINE = 'benchmark_baseline.json'
+
+ACCOUNT = '''query Account($session: String!) {
+  account(session: $session) {
+    name
+    email
+    mealsMade
+    masteredSkills
+    skills { name progress }
+    accountFlags { completedOrientation verified }
+    menus { menuIndex recipes { recipeId recipeName timeEstimate tags { name value } } }
+  }
+}'''
+
+REQUEST_MENUS = '''mutation RequestMenus($session: String!, $override: Boolean) {
+  requestMenus(recipeCount: 3, menuCount: 2, session: $session, override: $override) {
+    ok
+    menus {
+      menuIndex
+      recipes {
+        recipeName
+        recipeId
+        equipment { name quantity }
+        ingredients { name unit quantity }
+        steps { name steps { ingredients { name quantity unit } equipment { name quantity } skills { name } text } }
+        timeEstimate
+        description
+      }
+    }
+  }
+}'''
+
+RECIPE = '''query Recipe($recipeId: Int!) {
+  recipe(recipeId: $recipeId) {
+    recipeName
+    recipeId
+    description
+    timeEstimate
+    tags { name value }
+    ingredients { name unit quantity }
+    equipment { name quantity }
+    steps { name steps { text skills { name } } }
+  }
+}'''
+
+LOGIN = '''mutation Login($email: String!, $password: String!) {
+  login(email: $email, passwordInput: $password) {
+    ok
+    session
+    account { name accountFlags { completedOrientation verified } }
+  }
+}'''
+
+CHANGE_LOG = '''query ChangeLog($appVersion: String!) {
+  changeLog(appVersion: $appVersion) { major minor patch build majorChanges minorChanges patchChanges buildChanges }
+}'''
+
+
+class Scenario(NamedTuple):
+    name: str
+    document: str
+    variables: Callable[[], dict]
+
+
+def scenarios(graph: FakeGraph) -> List[Scenario]:
+    sessions = cycle(graph.sessions())
+    emails = cycle(graph.emails())
+    recipe_ids = cycle(sorted(graph.recipes))
+    return [
+        Scenario('account', ACCOUNT, lambda: {'session': next(sessions)}),
+        Scenario('requestMenus', REQUEST_MENUS, lambda: {'session': next(sessions), 'override': True}),
+        Scenario('requestMenus_existing', REQUEST_MENUS, lambda: {'session': next(sessions), 'override': False}),
+        Scenario('recipe', RECIPE, lambda: {'recipeId': next(recipe_ids)}),
+        Scenario('login', LOGIN, lambda: {'email': next(emails), 'password': 'password'}),
+        Scenario('changeLog', CHANGE_LOG, lambda: {'appVersion': '0.0.0.0'}),
+    ]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_scenario(app: Flask, graph: FakeGraph, scenario: Scenario, iterations: int, warmup: int) -> dict:
+    import query
+    from persisted_queries import backend
+
+    def execute():
+        variables = scenario.variables()
+        with app.app_context():
+            result = query.schema.execute(scenario.document, variables=variables, backend=backend)
+        if result.errors:
+            raise RuntimeError(f'{scenario.name} failed: {result.errors[0]}')
+
+    for _ in range(warmup):
+        execute()
+
+    graph.reset_counts()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        operation_start = time.perf_counter()
+        execute()
+        latencies.append(time.perf_counter() - operation_start)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    statements = sum(graph.counts.values())
+    return {
+        'operations': iterations,
+        'ops_per_second': iterations / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'statements_per_operation': statements / iterations,
+        'statements': dict(sorted(graph.counts.items())),
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result['statements_per_operation'] > expected['statements_per_operation'] + 1e-9:
+            regressions.append(f'{name}: {result["statements_per_operation"]:.2f} statements per operation, '
+                               f'baseline {expected["statements_per_operation"]:.2f}')
+        if result['ops_per_second'] < expected['ops_per_second'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["ops_per_second"]:.0f} ops/s, baseline '
+                               f'{expected["ops_per_second"]:.0f} ops/s (tolerance {tolerance:.0%})')
+    return regressions
+
+
+def print_report(results: Dict[str, dict]):
+    print(f'{"scenario":<24}{"ops/s":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"stmts/op":>10}')
+    for name, result in results.items():
+        print(f'{name:<24}{result["ops_per_second"]:>10.0f}{result["p50_ms"]:>10.3f}{result["p90_ms"]:>10.3f}'
+              f'{result["p99_ms"]:>10.3f}{result["statements_per_operation"]:>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark query.schema against an in-memory graph')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--scenario', action='append', help='Only run the named scenario(s)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=float(os.getenv('BENCHMARK_TOLERANCE', 0.25)),
+                        help='Allowed fractional drop in throughput before failing')
+    parser.add_argument('--output', help='Also write the results as json to this file')
+    args = parser.parse_args()
+
+    # Everything that asks for the database, including the recipe catalog and menu planner, gets the fake one
+    graph = FakeGraph(accounts=args.accounts)
+    database._graph_db = graph
+    app = Flask(__name__)
+
+    @app.teardown_appcontext
+    def close_db(error):
+        if hasattr(g, 'neo4j_db'):
+            graph.release(g.neo4j_db)
+
+    results = {}
+    for scenario in scenarios(graph):
+        if args.scenario and scenario.name not in args.scenario:
+            continue
+        results[scenario.name] = run_scenario(app, graph, scenario, args.iterations, args.warmup)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+import metrics
+
+"""
+Registry of every Cypher statement the server runs, keyed by name.
+
+Statements only ever take their inputs as parameters, so each one has a single query text and Neo4j can reuse its
+cached plan across requests.  Running statements through run() also records how often each one runs and how long
+the database took to answer it, and feeds the per-request statement and row counts in metrics.
+"""
+
+# Times a skill's recipes have to be made before the skill counts as mastered
+SKILL_MASTERY_COUNT = 7
+
+# Progress for made_count completions of a skill, capped at 1 once mastered
+SKILL_PROGRESS = f'''CASE WHEN made_count >= {SKILL_MASTERY_COUNT} THEN 1
+                    ELSE toFloat(made_count) / {SKILL_MASTERY_COUNT} END'''
+
+STATEMENTS: Dict[str, str] = {
+    # Accounts
+    'session_account': '''MATCH (a:Account {session: $session})
+        WITH a LIMIT 1
+        OPTIONAL MATCH (a)-[c:Made]->(r:Recipe) WHERE c.time > datetime.realtime() - duration({days: $recent_days})
+        RETURN id(a) AS account_id, a, collect(DISTINCT r.recipeId) AS recent_recipe_ids''',
+    'account_by_email': 'MATCH (a:Account {email: $email}) RETURN a LIMIT 1',
+    'account_exists': 'MATCH (a:Account {email: $email}) RETURN count(a) AS accounts',
+    'login_session': '''MATCH (a:Account {email: $email})-[:HasFlags]->(f: Flags) SET a.session = $session
+        WITH a, f
+        OPTIONAL MATCH (a)-[c:Made]->(r:Recipe) WHERE c.time > datetime.realtime() - duration({days: $recent_days})
+        RETURN id(a) AS account_id, a, f, collect(DISTINCT r.recipeId) AS recent_recipe_ids''',
+    'logout': 'MATCH (a:Account {session: $session}) SET a.session = null RETURN a',
+    'create_account': '''CREATE (a:Account {email: $email, name: $name, password: $password_hash,
+            session: $session, verified: false, completedOrientation: false}), (f:Flags),
+        (a)-[c:HasFlags]->(f)
+        SET a += $tags
+        RETURN id(a) AS account_id, a, c, f''',
+    'delete_account': '''MATCH (a:Account {session: $session})
+        CALL {
+            WITH a
+            MATCH (a)-[]->(m:Menu)
+            DETACH DELETE m
+            RETURN count(m) as menus
+        }
+        DETACH DELETE a
+        RETURN count(a) as accounts, menus''',
+    'set_account_tags': '''MATCH (a:Account) WHERE id(a) = $account_id AND a.session = $session
+        SET a += $tags RETURN a LIMIT 1''',
+    'set_account_flags': 'MATCH (a:Account {session: $session})-[]->(flags:Flags) SET flags += $flags RETURN flags',
+    'account_flags': '''MATCH (a:Account)-[]->(flags: Flags) WHERE id(a) = $account_id AND a.session = $session
+        RETURN flags''',
+    'account_meals_made': '''MATCH (a:Account)-[c:Made]-(r:Recipe) WHERE id(a) = $account_id AND a.session = $session
+        RETURN count(c) as meals_made''',
+    'account_mastered_skills': '''MATCH (a:Account)-[:HasSkill {progress: 1}]-(s:Skill)
+        WHERE id(a) = $account_id AND a.session = $session
+        RETURN count(s) as count''',
+    'account_skill_progress': '''MATCH (a:Account) WHERE id(a) = $account_id AND a.session = $session
+        MATCH (s:Skill)
+        OPTIONAL MATCH (a)-[h:HasSkill]->(s)
+        RETURN COALESCE(h.progress, 0) as progress, s.name as name''',
+    'user_skills': '''MATCH (a:Account {session: $session})
+        WITH a LIMIT 1
+        MATCH (s:Skill)
+        OPTIONAL MATCH (a)-[h:HasSkill]->(s)
+        RETURN COALESCE(h.progress, 0) as progress, s.name as name''',
+
+    # Recipes
+    'recipes_by_id': '''UNWIND $recipe_ids AS recipe_id
+        MATCH (r:Recipe {recipeId: recipe_id})
+        RETURN recipe_id, r''',
+    'all_recipes': 'MATCH (r:Recipe) RETURN r.recipeId AS recipe_id, r',
+    'suggestible_recipe_tags': '''MATCH (r:Recipe) WHERE toInteger(r.recipeId) < $max_recipe_id
+        RETURN DISTINCT r.recipeId AS recipe_id,
+            [key IN keys(r) WHERE key STARTS WITH 'tag_' AND r[key] = true] AS tags''',
+    'complete_recipe': '''MATCH (a: Account), (r: Recipe {recipeId: $recipe_id})
+        WHERE id(a) = $account_id AND a.session = $session
+        WITH a, r LIMIT 1
+        CREATE (a)-[c:Made {time: datetime.realtime()}]->(r)
+        WITH a, r, c
+        CALL {
+            WITH a, r
+            UNWIND COALESCE(r.skills, []) AS skill
+            MATCH (s:Skill {name: skill})
+            MERGE (a)-[h:HasSkill]->(s)
+            // Take the write lock before reading count, so concurrent completions cannot both read the same value
+            SET h._lock = true
+            WITH h, COALESCE(h.count, 0) + 1 AS made_count
+            SET h.count = made_count, h.progress = ''' + SKILL_PROGRESS + '''
+            REMOVE h._lock
+            RETURN count(h) AS skills
+        }
+        RETURN c, skills''',
+    # Rebuilds HasSkill counters from the Made history, for data written before complete_recipe maintained them
+    'backfill_skill_progress': '''MATCH (a:Account)-[:Made]->(r:Recipe)
+        UNWIND COALESCE(r.skills, []) AS skill
+        WITH a, skill, count(*) AS made_count
+        MATCH (s:Skill {name: skill})
+        MERGE (a)-[h:HasSkill]->(s)
+        SET h.count = made_count, h.progress = ''' + SKILL_PROGRESS + '''
+        RETURN count(h) AS skills''',
+
+    # Menus
+    'account_menus': '''MATCH (a:Account)-[]-(m: Menu) WHERE id(a) = $account_id AND a.session = $session
+        CALL {
+            WITH m MATCH (m)-[c:HasRecipe]-(r:Recipe)
+            WITH c, r ORDER BY c.position
+            RETURN COLLECT(r.recipeId) as recipe_ids
+        }
+        RETURN m, recipe_ids ORDER BY m.menu_index''',
+    'create_menus': '''MATCH (a: Account) WHERE id(a) = $account_id AND a.session = $session
+        WITH a
+        UNWIND $menus AS plan
+        CREATE (m: Menu {menu_index: plan.menu_index, time: datetime.realtime()}), (a)-[c:HasMenu]->(m)
+        WITH m, plan
+        CALL {
+            WITH m, plan
+            UNWIND range(0, size(plan.recipe_ids) - 1) AS position
+            MATCH (r:Recipe {recipeId: plan.recipe_ids[position]})
+            CREATE (m)-[c:HasRecipe {position: position}]->(r)
+            WITH position, r ORDER BY position
+            RETURN collect(DISTINCT r.recipeId) AS recipe_ids
+        }
+        RETURN m, recipe_ids ORDER BY m.menu_index''',
+
+    # Posts and pictures
+    'create_post': '''MATCH (a: Account), (r: Recipe {recipeId: $recipe_id})
+        WHERE id(a) = $account_id AND a.session = $session
+        CREATE (p: Post {caption: $caption, key: $key, bucket: $bucket, public: $public, time: datetime.realtime()}),
+        (a)-[c1:MadePost {time: datetime.realtime(), public: $public}]->(p),
+        (p)-[c2:AboutRecipe]->(r)
+        RETURN p''',
+    'create_recipe_image': '''MATCH (a: Account), (r: Recipe {recipeId: $recipe_id})
+        WHERE id(a) = $account_id AND a.session = $session
+        CREATE (node: RecipeImage {key: $key, bucket: $bucket}),
+        (a)-[c1:TookPicture{time: datetime.realtime()}]->(node),
+        (node)-[c2:PictureOf]->(r)
+        RETURN node''',
+}
+
+# Subqueries composed into the account statement for the Account fields selected in a request, see account_statement
+ACCOUNT_FIELD_QUERIES: Dict[str, str] = {
+    'menus': '''CALL {
+        WITH account
+        MATCH (account)-[]-(m:Menu)
+        CALL {
+            WITH m MATCH (m)-[c:HasRecipe]-(r:Recipe)
+            WITH c, r ORDER BY c.position
+            RETURN COLLECT(r.recipeId) AS recipe_ids
+        }
+        WITH m, recipe_ids ORDER BY m.menu_index
+        RETURN collect({m: m, recipe_ids: recipe_ids}) AS menus
+    }
+    ''',
+    'mealsMade': '''CALL {
+        WITH account
+        OPTIONAL MATCH (account)-[c:Made]-(:Recipe)
+        RETURN count(c) AS meals_made
+    }
+    ''',
+    'masteredSkills': '''CALL {
+        WITH account
+        OPTIONAL MATCH (account)-[:HasSkill {progress: 1}]-(s:Skill)
+        RETURN count(s) AS mastered_skills
+    }
+    ''',
+    'skills': '''CALL {
+        WITH account
+        MATCH (s:Skill)
+        OPTIONAL MATCH (account)-[h:HasSkill]->(s)
+        RETURN collect({name: s.name, progress: COALESCE(h.progress, 0)}) AS skills
+    }
+    ''',
+    'accountFlags': '''CALL {
+        WITH account
+        OPTIONAL MATCH (account)-[]->(flags:Flags)
+        RETURN head(collect(flags)) AS account_flags
+    }
+    ''',
+}
+
+ACCOUNT_FIELD_KEYS: Dict[str, str] = {'menus': 'menus', 'mealsMade': 'meals_made', 'masteredSkills': 'mastered_skills',
+                                      'skills': 'skills', 'accountFlags': 'account_flags'}
+
+
+def account_statement(selected: Iterable[str]) -> Tuple[str, list]:
+    """
+    Register (once) and return the name of the account statement fetching the given Account fields, along with the
+    fields it covers in order.  There are at most 2^5 variants, so each still gets a cached plan.
+    """
+    fields = [field for field in ACCOUNT_FIELD_QUERIES if field in set(selected)]
+    name = 'account_with:' + ','.join(fields)
+    if name not in STATEMENTS:
+        STATEMENTS[name] = 'MATCH (account:Account) WHERE id(account) = $account_id AND account.session = $session\n' \
+                           + ''.join(ACCOUNT_FIELD_QUERIES[field] for field in fields) \
+                           + 'RETURN ' + ', '.join(['account'] + [ACCOUNT_FIELD_KEYS[field] for field in fields])
+    return name, fields
+
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, list] = {}
+
+
+def run(runner, name: str, parameters: dict = None):
+    """
+    Run the registered statement name with runner, anything with a neo4j Session style run(query, parameters=...)
+    such as a session or GraphDB.  The recorded latency is the time until the database answered.
+    """
+    start = time.perf_counter()
+    try:
+        result = runner.run(STATEMENTS[name], parameters=parameters if parameters is not None else {})
+    finally:
+        _record(name, time.perf_counter() - start)
+
+    if isinstance(result, list):
+        metrics.record_rows(name, len(result))
+        return result
+    return metrics.CountedResult(result, name)
+
+
+async def run_async(runner, name: str, parameters: dict = None) -> list:
+    """run() for an AsyncGraphDB, returning every record once the statement has finished."""
+    start = time.perf_counter()
+    try:
+        records = await runner.run(STATEMENTS[name], parameters=parameters if parameters is not None else {})
+    finally:
+        _record(name, time.perf_counter() - start)
+    metrics.record_rows(name, len(records))
+    return records
+
+
+def _record(name: str, elapsed: float):
+    metrics.record_statement(name, elapsed)
+    with _stats_lock:
+        stats = _stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+
+def statement_stats() -> Dict[str, dict]:
+    with _stats_lock:
+        return {name: {'count': count, 'total_ms': total * 1000, 'mean_ms': total * 1000 / count,
+                       'max_ms': longest * 1000}
+                for name, (count, total, longest) in _stats.items()}
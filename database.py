@@ -1,8 +1,16 @@
+import atexit
+import threading
+
 import neo4j
-from neo4j import GraphDatabase, basic_auth
+from neo4j import AsyncGraphDatabase, GraphDatabase, basic_auth
 from neo4j.exceptions import ServiceUnavailable
 import os
 
+import cypher
+import log
+
+logger = log.get_logger(__name__)
+
 def unpack(node):
     obj = {}
     for key in node:
@@ -22,71 +30,161 @@ def unpack_single(result, keys=[]):
     return unpack(result.single())
     
 
-
-class GraphDB():
-    def __init__(self):
-        if not os.path.exists('.dev'):
-            if os.path.exists('.db_uri'):
-                with open('.db_uri', 'r') as file:
-                    os.environ['DB_URI'] = file.read().strip()
-            if os.path.exists('.db_password'):
-                with open('.db_password', 'r') as file:
-                    os.environ['DB_PASSWORD'] = file.read().strip()
-
-        url = os.getenv('DB_URI') if os.getenv('DB_URI') is not None else "bolt://localhost"
-        password = os.getenv('DB_PASSWORD') if os.getenv('DB_PASSWORD') is not None else 'memphis-place-optimal-velvet-phantom-127'
-
-        self.driver = GraphDatabase.driver(url, auth=("neo4j", password))
+def load_credentials():
+    """Return the (url, password) pair for the neo4j instance, reading .db_uri/.db_password when present."""
+    if not os.path.exists('.dev'):
+        if os.path.exists('.db_uri'):
+            with open('.db_uri', 'r') as file:
+                os.environ['DB_URI'] = file.read().strip()
+        if os.path.exists('.db_password'):
+            with open('.db_password', 'r') as file:
+                os.environ['DB_PASSWORD'] = file.read().strip()
+
+    url = os.getenv('DB_URI') if os.getenv('DB_URI') is not None else "bolt://localhost"
+    password = os.getenv('DB_PASSWORD') if os.getenv('DB_PASSWORD') is not None else 'memphis-place-optimal-velvet-phantom-127'
+    return url, password
+
+
+def pool_config():
+    """
+    Driver pool settings, overridable through the environment:
+        DB_MAX_POOL_SIZE            maximum connections held by the driver (default 50)
+        DB_ACQUISITION_TIMEOUT      seconds to wait for a free connection (default 30)
+        DB_MAX_CONNECTION_LIFETIME  seconds before a pooled connection is recycled (default 3600)
+        DB_LIVENESS_CHECK_TIMEOUT   idle seconds before a connection is pinged on checkout
+    """
+    config = {
+        'max_connection_pool_size': int(os.getenv('DB_MAX_POOL_SIZE', 50)),
+        'connection_acquisition_timeout': float(os.getenv('DB_ACQUISITION_TIMEOUT', 30)),
+        'max_connection_lifetime': float(os.getenv('DB_MAX_CONNECTION_LIFETIME', 3600)),
+    }
+    if os.getenv('DB_LIVENESS_CHECK_TIMEOUT') is not None:
+        config['liveness_check_timeout'] = float(os.getenv('DB_LIVENESS_CHECK_TIMEOUT'))
+    return config
 
 
+class GraphDB():
+    def __init__(self, **config):
+        url, password = load_credentials()
+        self.config = {**pool_config(), **config}
+
+        self.driver = GraphDatabase.driver(url, auth=basic_auth("neo4j", password), **self.config)
+
+        self._lock = threading.Lock()
+        self._open_sessions = 0
+
+    def session(self):
+        """Open a session on the shared driver.  Sessions handed out here must be given back with release()."""
+        session = self.driver.session()
+        with self._lock:
+            self._open_sessions += 1
+        return session
+
+    def release(self, session):
+        """Close a session opened with session(), returning its connection to the pool."""
+        try:
+            session.close()
+        finally:
+            with self._lock:
+                self._open_sessions -= 1
 
     def run(self, query, parameters=dict()):
-        print("Trying to run neo4j command")
-        result = None
-        with self.driver.session() as session:
-            result = session.run(query, parameters=parameters)
-        return result
+        session = self.session()
+        try:
+            return list(session.run(query, parameters=parameters))
+        finally:
+            self.release(session)
+
+    def verify(self) -> bool:
+        """Liveness check against the database, used at startup and by the monitoring route."""
+        try:
+            self.run('RETURN 1 AS alive')
+        except ServiceUnavailable as e:
+            logger.warning('Database is unreachable', error=e)
+            return False
+        return True
+
+    def pool_stats(self):
+        """
+        Snapshot of the connection pool.  The driver does not expose how many threads are blocked waiting for a
+        connection, so sessions_over_capacity only reports how many open sessions exceed the pool size.
+        """
+        in_use = 0
+        idle = 0
+        # The driver keeps its pool private, so read it defensively in case the internals move between versions
+        pool = getattr(self.driver, '_pool', None)
+        connections = getattr(pool, 'connections', {})
+        for address_connections in list(connections.values()):
+            for connection in list(address_connections):
+                if connection.in_use:
+                    in_use += 1
+                else:
+                    idle += 1
+
+        max_size = self.config['max_connection_pool_size']
+        with self._lock:
+            open_sessions = self._open_sessions
+        return {'in_use': in_use, 'idle': idle, 'sessions_over_capacity': max(0, open_sessions - max_size),
+                'open_sessions': open_sessions, 'max_size': max_size}
 
     def get_user_skills(self, session):
-        query = 'MATCH (a:Account {session: $session}),(s:Skill) OPTIONAL MATCH (a)-[c:HasSkill]->(s) RETURN ' \
-                'COALESCE(c.progress, 0) as progress, s.name as name'
-        results = self.run(query, parameters = {'session': session})
-        skills = {}
-        for record in results:
-            d = {"progress": record.get("progress") if not None else 0, "name": record.get("name")}
-            if "progress" not in d:
-                d['progress'] = 0
-            skills[d['name']] = d
-            # print(d)
-
-        get_completed_recipe_skills = '''MATCH (a:Account {session: $session}),
-            (a)-[c:Made]->(r: Recipe)
-            WITH a, c, r CALL {
-                WITH a, c, r
-                UNWIND r.skills as skill
-                RETURN skill
-            }
-            RETURN skill , count(skill) as skill_count
-        '''
-
-        results = self.run(get_completed_recipe_skills, parameters={'session': session})
-        for record in results:
-            count = record.get("skill_count")
-            print(record)
-            skill_name = record.get("skill")
-            print(f"count: {count}, skill: {skill_name}")
-            if count is not None:
-                skills[skill_name]["progress"] = min(count / 7, 1)
-        
-        print(skills)
-
-        return list(skills.values())
+        results = cypher.run(self, 'user_skills', {'session': session})
+        return [{"progress": record.get("progress"), "name": record.get("name")} for record in results]
 
 
     def close(self):
-        print("Closing driver")
+        logger.info('Closing driver')
         self.driver.close()
 
 
+_graph_db = None
+_graph_db_lock = threading.Lock()
+
+
+def get_graph_db() -> GraphDB:
+    """Return the process-wide GraphDB, creating its driver on first use."""
+    global _graph_db
+    if _graph_db is None:
+        with _graph_db_lock:
+            if _graph_db is None:
+                _graph_db = GraphDB()
+                atexit.register(_graph_db.close)
+    return _graph_db
+
+
+class AsyncGraphDB():
+    """GraphDB counterpart on the asyncio driver (neo4j>=5), used by the resolvers asgi.py runs on its event loop."""
+
+    def __init__(self, **config):
+        url, password = load_credentials()
+        self.config = {**pool_config(), **config}
+
+        self.driver = AsyncGraphDatabase.driver(url, auth=basic_auth("neo4j", password), **self.config)
+
+    async def run(self, query, parameters=dict()):
+        # A session per statement, so resolvers awaiting statements side by side each get their own connection
+        async with self.driver.session() as session:
+            result = await session.run(query, parameters=parameters)
+            return [record async for record in result]
+
+    async def close(self):
+        logger.info('Closing async driver')
+        await self.driver.close()
+
+
+_async_graph_db = None
+
+
+def get_async_graph_db() -> AsyncGraphDB:
+    """Return the process-wide AsyncGraphDB.  Only ever called on the event loop, so it needs no lock."""
+    global _async_graph_db
+    if _async_graph_db is None:
+        _async_graph_db = AsyncGraphDB()
+    return _async_graph_db
+
 
-db_connection = GraphDB()
+async def close_async_graph_db():
+    global _async_graph_db
+    if _async_graph_db is not None:
+        await _async_graph_db.close()
+        _async_graph_db = None
@@ -0,0 +1,228 @@
+import glob
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import cypher
+from utils import create_password
+
+"""
+In-memory stand-in for the Neo4j database, for benchmarking query.schema without a server.
+
+FakeGraph answers the statements in the cypher registry by name (the composed account statements included) from
+plain dicts seeded with recipes/*.json and synthetic accounts, and counts how often each statement ran.  It mirrors
+what the statements return, not how Neo4j plans them, so it measures the Python side of a request and the number of
+round trips it makes.  Statements it does not know raise UnsupportedStatement so a new one can't silently skip work.
+"""
+
+
+class UnsupportedStatement(LookupError):
+    """A statement FakeGraph has no handler for, named by its registry name or its text."""
+
+
+class FakeResult():
+    def __init__(self, records: List[dict]):
+        self._records = [FakeRecord(record) for record in records]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def single(self):
+        return self._records[0] if len(self._records) > 0 else None
+
+
+class FakeRecord(dict):
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+
+class FakeGraph():
+    """Quacks like both database.GraphDB and the sessions it hands out."""
+
+    def __init__(self, recipe_dir: str = 'recipes', accounts: int = 50, meals_per_account: int = 30, seed: int = 0):
+        self._lock = threading.Lock()
+        self._names: Dict[str, str] = {}
+        self.counts: Dict[str, int] = {}
+        self.recipes: Dict[int, dict] = {}
+        self.skills = set()
+        self.accounts: Dict[int, dict] = {}
+        self._by_session: Dict[str, int] = {}
+        self._by_email: Dict[str, int] = {}
+        self._load_recipes(recipe_dir)
+        self._create_accounts(accounts, meals_per_account, random.Random(seed))
+
+    # Seeding
+
+    def _load_recipes(self, recipe_dir):
+        for filename in sorted(glob.glob(os.path.join(recipe_dir, '*.json'))):
+            with open(filename, 'r') as file:
+                json_string = file.read()
+            j = json.loads(json_string)
+            skills = sorted({skill['name'].lower() for macro_step in j['steps'] for micro_step in macro_step['steps']
+                             for skill in micro_step['skills']})
+            node = {'recipeId': int(j['recipe_id']), 'recipeName': j['recipe_name'], 'skills': skills,
+                    'json': json_string}
+            node.update({f'tag_{key}': value for key, value in j['tags'].items()})
+            self.recipes[node['recipeId']] = node
+            self.skills.update(skills)
+
+    def _create_accounts(self, count, meals_per_account, rng):
+        recipe_ids = sorted(self.recipes)
+        tags = sorted({key for recipe in self.recipes.values() for key in recipe if key.startswith('tag_')})
+        for index in range(count):
+            email = f'account{index}@benchmark.test'
+            node = {'email': email, 'name': f'account{index}', 'password': create_password('password'),
+                    'session': uuid.uuid4().hex, 'verified': True, 'completedOrientation': True}
+            node.update({tag: rng.random() < 0.3 for tag in tags})
+            account = {'id': index, 'node': node, 'flags': {'verified': True, 'completed_orientation': True},
+                       'made': [], 'skills': {}, 'menus': []}
+            self.accounts[index] = account
+            self._by_session[node['session']] = index
+            self._by_email[email] = index
+            for _ in range(meals_per_account):
+                self._complete(account, rng.choice(recipe_ids), time.time() - rng.random() * 60 * 86400)
+            self._set_menus(account, [{'menu_index': i + 1, 'recipe_ids': rng.sample(recipe_ids, 3)}
+                                      for i in range(2)])
+
+    def sessions(self) -> List[str]:
+        return [account['node']['session'] for account in self.accounts.values()]
+
+    def emails(self) -> List[str]:
+        return [account['node']['email'] for account in self.accounts.values()]
+
+    # GraphDB and session interface
+
+    def session(self):
+        return self
+
+    def release(self, session):
+        pass
+
+    def close(self):
+        pass
+
+    def run(self, query, parameters=None):
+        name = self._names.get(query)
+        if name is None:
+            self._names = {text: name for name, text in cypher.STATEMENTS.items()}
+            name = self._names.get(query)
+        if name is None or not hasattr(self, '_' + name.split(':')[0]):
+            raise UnsupportedStatement(f'Unsupported statement, FakeGraph does not answer {name or query}')
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            handler = getattr(self, '_' + name.split(':')[0])
+            if name.startswith('account_with:'):
+                return FakeResult(handler(name.split(':')[1].split(','), **(parameters or {})))
+            return FakeResult(handler(**(parameters or {})))
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+
+    # Helpers
+
+    def _account(self, account_id=None, session=None):
+        if account_id is None:
+            account_id = self._by_session.get(session)
+        account = self.accounts.get(account_id)
+        if account is None or account['node']['session'] != session:
+            return None
+        return account
+
+    def _recent(self, account, recent_days):
+        cutoff = time.time() - recent_days * 86400
+        return sorted({recipe_id for recipe_id, made in account['made'] if made > cutoff})
+
+    def _complete(self, account, recipe_id, made):
+        account['made'].append((recipe_id, made))
+        for skill in self.recipes[recipe_id]['skills']:
+            progress = account['skills'].setdefault(skill, {'count': 0, 'progress': 0})
+            progress['count'] += 1
+            progress['progress'] = min(progress['count'] / cypher.SKILL_MASTERY_COUNT, 1)
+
+    def _set_menus(self, account, menus):
+        # Only the latest menus are kept so repeated benchmark runs read the same amount of data
+        account['menus'] = [({'menu_index': menu['menu_index']}, list(menu['recipe_ids'])) for menu in menus]
+
+    def _menu_records(self, account):
+        return [{'m': menu, 'recipe_ids': recipe_ids} for menu, recipe_ids in account['menus']]
+
+    # Statements, one method per registry name
+
+    def _session_account(self, session, recent_days):
+        account = self._account(session=session)
+        if account is None:
+            return []
+        return [{'account_id': account['id'], 'a': account['node'],
+                 'recent_recipe_ids': self._recent(account, recent_days)}]
+
+    def _account_by_email(self, email):
+        account = self.accounts.get(self._by_email.get(email))
+        return [] if account is None else [{'a': dict(account['node'])}]
+
+    def _account_exists(self, email):
+        return [{'accounts': 1 if email in self._by_email else 0}]
+
+    def _login_session(self, email, session, recent_days):
+        account = self.accounts.get(self._by_email.get(email))
+        if account is None:
+            return []
+        self._by_session.pop(account['node']['session'], None)
+        account['node']['session'] = session
+        self._by_session[session] = account['id']
+        return [{'account_id': account['id'], 'a': dict(account['node']), 'f': dict(account['flags']),
+                 'recent_recipe_ids': self._recent(account, recent_days)}]
+
+    def _account_menus(self, account_id, session):
+        account = self._account(account_id, session)
+        return [] if account is None else self._menu_records(account)
+
+    def _create_menus(self, account_id, session, menus):
+        account = self._account(account_id, session)
+        if account is None:
+            return []
+        self._set_menus(account, [{'menu_index': menu['menu_index'],
+                                   'recipe_ids': [recipe_id for recipe_id in menu['recipe_ids']
+                                                  if recipe_id in self.recipes]} for menu in menus])
+        return self._menu_records(account)
+
+    def _complete_recipe(self, account_id, session, recipe_id):
+        account = self._account(account_id, session)
+        if account is None or recipe_id not in self.recipes:
+            return []
+        self._complete(account, recipe_id, time.time())
+        return [{'c': {}, 'skills': len(self.recipes[recipe_id]['skills'])}]
+
+    def _account_with(self, fields, account_id, session):
+        account = self._account(account_id, session)
+        if account is None:
+            return []
+        record = {'account': dict(account['node'])}
+        if 'menus' in fields:
+            record['menus'] = self._menu_records(account)
+        if 'mealsMade' in fields:
+            record['meals_made'] = len(account['made'])
+        if 'masteredSkills' in fields:
+            record['mastered_skills'] = sum(1 for skill in account['skills'].values() if skill['progress'] == 1)
+        if 'skills' in fields:
+            record['skills'] = [{'name': skill, 'progress': account['skills'].get(skill, {}).get('progress', 0)}
+                                for skill in sorted(self.skills)]
+        if 'accountFlags' in fields:
+            record['account_flags'] = dict(account['flags'])
+        return [record]
+
+    def _recipes_by_id(self, recipe_ids):
+        return [{'recipe_id': recipe_id, 'r': self.recipes[recipe_id]} for recipe_id in recipe_ids
+                if recipe_id in self.recipes]
+
+    def _all_recipes(self):
+        return [{'recipe_id': recipe_id, 'r': recipe} for recipe_id, recipe in self.recipes.items()]
+
+    def _suggestible_recipe_tags(self, max_recipe_id):
+        return [{'recipe_id': recipe_id, 'tags': [key for key, value in recipe.items()
+                                                  if key.startswith('tag_') and value is True]}
+                for recipe_id, recipe in self.recipes.items() if recipe_id < max_recipe_id]
@@ -1,48 +1,76 @@
 #!venv/bin/python
 from flask import Flask, jsonify, g, request, Response, render_template
 import graphene
-from database import db_connection
-from graphene_file_upload.flask import FileUploadGraphQLView
+from database import get_graph_db
+from response_cache import CachingGraphQLView
 import query
+import cypher
+import metrics
 import json
 import os
 import utils
 import sys
+import threading
 import time
-from recipe_parser import RecipeParser
-from recipe_loader import clear_one_recipe, update_recipe
-import logging
+from recipe_parser import get_recipe_parser
+from recipe_loader import get_loader
+from recipe_catalog import catalog
+import graph_schema
+from neo4j.exceptions import Neo4jError, ServiceUnavailable
+import log
+
+# Everything, app.logger included, goes through the queue backed handlers in log (LOG_FILE replaces debug.log)
+log.configure()
+logger = log.get_logger(__name__)
 
 app = Flask(__name__)
-handler = logging.FileHandler("debug.log")
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.DEBUG)
+
+_started = False
+_startup_lock = threading.Lock()
+
+
+def startup():
+    """Verify the database schema and warm the recipe catalog, once per process whichever server imported the app."""
+    global _started
+    if _started:
+        return
+    with _startup_lock:
+        if _started:
+            return
+        try:
+            graph_schema.verify()
+        except (ServiceUnavailable, Neo4jError) as e:
+            # Schema problems are only reported, the app keeps serving either way
+            logger.warning('Could not verify the database schema', error=e)
+        catalog.warm()
+        _started = True
 
 
 @app.route('/recipes')
 def recipe_search():
-    rp = RecipeParser()
+    rp = get_recipe_parser()
     recipe_names = rp.get_recipe_names()
     return render_template("recipe_search.html", recipes=recipe_names)
 
 
 @app.route('/recipes/<recipe_id>')
 def display_recipes(recipe_id: str):
-    print("Displaying recipe")
-    rp = RecipeParser()
+    logger.debug('Displaying recipe', recipe_id=recipe_id)
+    rp = get_recipe_parser()
     recipe_json, recipe_html, _ = rp.get_recipe(recipe_id=recipe_id)
     return render_template("recipe_display.html", rendering=recipe_html, recipe=recipe_json)
 
 @app.route('/recipes/<recipe_id>/update')
 def update_recipe_data(recipe_id):
-    rp = RecipeParser()
-    recipe_json, _, filename = rp.get_recipe(recipe_id=recipe_id)
+    rp = get_recipe_parser()
+    recipe_json, _, filename = rp.get_recipe(recipe_id=recipe_id, check=True)
 
     with open(filename, 'w') as file:
-        print(f"Writing newest version of {recipe_json['recipe_name']} locally")
+        logger.info('Writing newest version of recipe locally', recipe=recipe_json['recipe_name'])
         json.dump(recipe_json, file, indent=2, sort_keys=True)
     
-    update_recipe(recipe_json, is_dict=True)
+    get_loader().update_recipe(recipe_json, is_dict=True)
+    catalog.invalidate(recipe_json['recipe_id'])
     return {"response": "Updating the recipe"}
 
 @app.route('/logs/<year>/<month>/<day>')
@@ -56,13 +84,26 @@ def get_logs(year, month, day):
 
 @app.route('/recipes/<recipe_id>/delete')
 def delete_recipe(recipe_id):
-    clear_one_recipe(int(recipe_id))
+    get_loader().clear_one_recipe(int(recipe_id))
+    catalog.invalidate(recipe_id)
     return {"response": "Deleting the recipe"}
 
 @app.teardown_appcontext
 def close_db(error):
     if hasattr(g, 'neo4j_db'):
-        g.neo4j_db.close()
+        get_graph_db().release(g.neo4j_db)
+
+@app.route('/stats/db')
+def db_pool_stats():
+    return jsonify(get_graph_db().pool_stats())
+
+@app.route('/stats/queries')
+def query_stats():
+    return jsonify(cypher.statement_stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.exposition(), content_type='text/plain; version=0.0.4')
 
 @app.route("/")
 def server_is_up():
@@ -73,21 +114,26 @@ def server_is_up():
 #     print('Headers: %s', request.headers)
 #     print('Body: %s', request.query_string)
 
+@app.before_request
+def run_startup():
+    startup()
+
 @app.before_request
 def store_time():
     g.start = time.time()
 
 @app.teardown_request
 def log_time(exception=None):
-    print(f'Request took {time.time() - g.start} seconds to serve')
+    logger.info('Served request', path=request.path, seconds=round(time.time() - g.start, 4))
 
 app.add_url_rule(
     '/graphql',
     methods=['GET', 'POST'],
-    view_func=FileUploadGraphQLView.as_view(
+    view_func=CachingGraphQLView.as_view(
         'graphql',
         schema=query.schema,
-        graphiql=True
+        graphiql=True,
+        middleware=[metrics.MetricsMiddleware()]
     )
 )
 
@@ -97,4 +143,5 @@ if __name__ == '__main__':
     else:
         port = 8080
 
+    startup()
     app.run(host='0.0.0.0', port=port)
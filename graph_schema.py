@@ -0,0 +1,106 @@
+#!venv/bin/python
+import sys
+from typing import List, Tuple
+
+from neo4j.exceptions import ClientError
+
+import cypher
+from database import get_graph_db
+
+"""
+Indexes and uniqueness constraints for the properties the resolvers look nodes up by.
+
+Run ./graph_schema.py migrate to create whatever is missing; every statement is IF NOT EXISTS, so it is safe to run
+on every deploy.  ./graph_schema.py verify (also run when graph.py starts) only reports what is missing.  The syntax
+targets Neo4j 5 (CREATE CONSTRAINT ... FOR ... REQUIRE, SHOW INDEXES/SHOW CONSTRAINTS), matching the 5.x driver.
+
+./graph_schema.py backfill-skills rebuilds the HasSkill progress counters from every account's Made history, needed
+once for data written before CompleteRecipe maintained them; it recomputes the counters, so rerunning it is harmless.
+
+Recipe.recipeId is indexed rather than constrained because recipe_loader tolerates (and later merges) duplicate
+recipe nodes, which a uniqueness constraint would turn into failed loads.
+"""
+
+# (name, label, property, unique)
+SCHEMA: List[Tuple[str, str, str, bool]] = [
+    ('account_email', 'Account', 'email', True),
+    ('account_session', 'Account', 'session', True),
+    ('skill_name', 'Skill', 'name', True),
+    ('recipe_recipe_id', 'Recipe', 'recipeId', False),
+]
+
+
+def create_statement(name, label, prop, unique):
+    if unique:
+        return f'CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE n.{prop} IS UNIQUE'
+    return f'CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON (n.{prop})'
+
+
+def existing_schema(graph_db=None):
+    """(label, property, unique) for every single property node index and uniqueness constraint in the database."""
+    graph_db = graph_db if graph_db is not None else get_graph_db()
+    existing = set()
+    # The indexes backing a constraint are listed by SHOW CONSTRAINTS, plain indexes have no owningConstraint
+    indexes = graph_db.run("SHOW INDEXES YIELD entityType, labelsOrTypes, properties, owningConstraint "
+                           "WHERE entityType = 'NODE' AND owningConstraint IS NULL "
+                           "RETURN labelsOrTypes, properties, false AS unique")
+    # Depending on the server version, node uniqueness constraints are typed UNIQUENESS or NODE_PROPERTY_UNIQUENESS
+    constraints = graph_db.run("SHOW CONSTRAINTS YIELD entityType, labelsOrTypes, properties, type "
+                               "WHERE entityType = 'NODE' AND type IN ['UNIQUENESS', 'NODE_PROPERTY_UNIQUENESS'] "
+                               "RETURN labelsOrTypes, properties, true AS unique")
+    for record in list(indexes) + list(constraints):
+        labels = record.get('labelsOrTypes') or []
+        properties = record.get('properties') or []
+        if len(labels) == 1 and len(properties) == 1:
+            existing.add((labels[0], properties[0], record.get('unique')))
+    return existing
+
+
+def missing_schema(graph_db=None):
+    existing = existing_schema(graph_db)
+    return [entry for entry in SCHEMA if entry[1:] not in existing]
+
+
+def verify(graph_db=None) -> bool:
+    missing = missing_schema(graph_db)
+    for name, label, prop, unique in missing:
+        print(f'Missing {"uniqueness constraint" if unique else "index"} {name} on :{label}({prop}), '
+              f'run ./graph_schema.py migrate')
+    if len(missing) == 0:
+        print('All indexes and constraints are in place')
+    return len(missing) == 0
+
+
+def migrate(graph_db=None) -> bool:
+    graph_db = graph_db if graph_db is not None else get_graph_db()
+    for entry in missing_schema(graph_db):
+        statement = create_statement(*entry)
+        print(f'Running: {statement}')
+        try:
+            graph_db.run(statement)
+        except ClientError as e:
+            # Typically existing duplicates blocking a uniqueness constraint, which verify reports below
+            print(f'Failed to create {entry[0]}: {e}')
+    return verify(graph_db)
+
+
+def backfill_skill_progress(graph_db=None) -> bool:
+    graph_db = graph_db if graph_db is not None else get_graph_db()
+    records = cypher.run(graph_db, 'backfill_skill_progress')
+    print(f'Rebuilt {records[0].get("skills") if len(records) > 0 else 0} skill progress counters')
+    return True
+
+
+COMMANDS = {'migrate': migrate, 'verify': verify, 'backfill-skills': backfill_skill_progress}
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        print(f'Usage: ./graph_schema.py {"|".join(COMMANDS)}')
+        return
+    ok = COMMANDS[sys.argv[1]]()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+import metrics
+
+"""
+Structured, sampled and non-blocking logging for the server.
+
+get_logger(name) returns a logger taking key/value fields, e.g. logger.info('Logged in', email=email).  A request
+thread only builds the record and puts it on a bounded queue (LOG_QUEUE_SIZE); formatting to a json line and writing
+to stdout and LOG_FILE happen on a listener thread.  When the queue is full the record is dropped rather than
+blocking the request.  Emitted, sampled out and dropped records are counted in metrics.
+
+LOG_LEVEL sets the default level and LOG_LEVELS overrides it per logger (query=DEBUG,database=WARNING).  LOG_SAMPLING
+keeps only a fraction of the records below WARNING per logger (query=0.1); warnings and errors are always kept.  Field
+values are cut to LOG_MAX_FIELD_LENGTH characters, so one record costs the same whatever payload it describes.
+
+Only the server entry points (graph.py, asgi.py) call configure(), so importing a module that logs leaves the
+logging of CLIs, the benchmark and test harnesses alone.
+
+Fields are formatted on the listener thread, so pass ids, counts and strings rather than objects that keep changing.
+"""
+
+MAX_FIELD_LENGTH = int(os.getenv('LOG_MAX_FIELD_LENGTH', 200))
+
+
+def _parse_settings(value: str) -> Dict[str, str]:
+    settings = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, setting = item.split('=', 1)
+            settings[name.strip()] = setting.strip()
+    return settings
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        for key, value in getattr(record, 'fields', {}).items():
+            if not isinstance(value, (int, float, bool)) and value is not None:
+                value = str(value)
+                if len(value) > MAX_FIELD_LENGTH:
+                    value = value[:MAX_FIELD_LENGTH] + '...'
+            entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or random.random() < self.rate:
+            return True
+        metrics.record_log('sampled_out')
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks: full queue means a dropped record, and formatting waits for the listener."""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            metrics.record_log('emitted')
+        except queue.Full:
+            metrics.record_log('dropped')
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in ('exc_info', 'stack_info', 'stacklevel')}
+        kwargs['extra'] = {'fields': fields}
+        return msg, kwargs
+
+
+_configure_lock = threading.Lock()
+_listener = None
+
+
+def configure():
+    """Route the root logger through the queue, once per process."""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        handlers = [logging.StreamHandler(sys.stdout)]
+        if os.getenv('LOG_FILE'):
+            handlers.append(logging.FileHandler(os.getenv('LOG_FILE')))
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+
+        log_queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+        root = logging.getLogger()
+        root.handlers = [DroppingQueueHandler(log_queue)]
+        root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        for name, level in _parse_settings(os.getenv('LOG_LEVELS', '')).items():
+            logging.getLogger(name).setLevel(level.upper())
+        for name, rate in _parse_settings(os.getenv('LOG_SAMPLING', '')).items():
+            logging.getLogger(name).addFilter(SamplingFilter(float(rate)))
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out whatever is still queued."""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name: str) -> StructuredLogger:
+    """Logger for a module.  Nothing is routed through the queue until an entry point calls configure()."""
+    return StructuredLogger(logging.getLogger(name), {})
@@ -1,5 +1,10 @@
 
-from query import run_query
+from query import schema
+
+
+def run_query(query_string):
+    result = schema.execute(query_string)
+    return result.errors if result.errors else result.data
 
 
 def main():
@@ -8,7 +13,7 @@ def main():
     query_string = '{ hello(name: "GraphQL") }'
     print(run_query(query_string))
 
-    query_string = '{ menu(numMenus: 2) { recipes(numRecipes: 2){ recipeName ingredients {name quantity} }}}'
+    query_string = '{ menu(numMenus: 2) { recipes { recipeName ingredients {name quantity} }}}'
     print(run_query(query_string))
 
 
@@ -0,0 +1,116 @@
+import os
+import random
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+
+import cypher
+from database import get_graph_db
+from recipe_catalog import catalog
+
+"""
+Menu sampling done in Python against a small index of the recipes that can be suggested.
+
+The index maps every tag_* flag that is true on a recipe to the ids carrying it, so the recipes matching a set of
+dietary restrictions are one set intersection away (cached per combination of tags) and a menu is drawn with
+random sampling instead of a label scan + ORDER BY rand() per menu in Neo4j.  The index is rebuilt lazily after
+MENU_INDEX_TTL seconds or whenever the recipe catalog is invalidated.
+"""
+
+# Recipes at or above this id are drafts and are never suggested
+MAX_SUGGESTED_RECIPE_ID = 1000
+
+
+class MenuPlanner():
+    def __init__(self, ttl: float = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('MENU_INDEX_TTL', 600))
+        self._lock = threading.Lock()
+        self._expires = 0
+        self._eligible: Tuple[int, ...] = ()
+        self._by_tag: Dict[str, FrozenSet[int]] = {}
+        self._candidates: Dict[FrozenSet[str], Tuple[int, ...]] = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0
+
+    def _refresh(self):
+        with self._lock:
+            if self._expires > time.monotonic():
+                return
+            eligible = set()
+            by_tag = {}
+            parameters = {'max_recipe_id': MAX_SUGGESTED_RECIPE_ID}
+            for record in cypher.run(get_graph_db(), 'suggestible_recipe_tags', parameters):
+                recipe_id = record.get('recipe_id')
+                eligible.add(recipe_id)
+                for tag in record.get('tags'):
+                    by_tag.setdefault(tag, set()).add(recipe_id)
+
+            self._eligible = tuple(sorted(eligible))
+            self._by_tag = {tag: frozenset(recipe_ids) for tag, recipe_ids in by_tag.items()}
+            self._candidates = {}
+            self._expires = time.monotonic() + self.ttl
+
+    def candidates(self, tags: Iterable[str]) -> Tuple[int, ...]:
+        """Ids of the suggestible recipes that have every one of the given tag_* flags set."""
+        self._refresh()
+        tags = frozenset(tags)
+        with self._lock:
+            if tags not in self._candidates:
+                recipe_ids = set(self._eligible)
+                for tag in sorted(tags, key=lambda t: len(self._by_tag.get(t, ()))):
+                    recipe_ids &= self._by_tag.get(tag, frozenset())
+                self._candidates[tags] = tuple(sorted(recipe_ids))
+            return self._candidates[tags]
+
+    def plan(self, tags: Iterable[str], recipe_count: int, menu_count: int, avoid_repeats: bool = True,
+             avoid: Iterable[int] = ()) -> List[List[int]]:
+        """
+        Sample menu_count menus of up to recipe_count distinct recipes each.  With avoid_repeats, a recipe is only
+        reused across menus once the candidates run out; recipes in avoid (e.g. recently made ones) are skipped
+        unless there aren't enough other recipes to fill a menu.
+        """
+        candidates = self.candidates(tags)
+        recipe_count = min(recipe_count, len(candidates))
+        used = set(avoid)
+        menus = []
+        for _ in range(menu_count):
+            menu = _draw(candidates, recipe_count, used)
+            if avoid_repeats:
+                used.update(menu)
+            menus.append(menu)
+        return menus
+
+
+def _draw(candidates: Tuple[int, ...], k: int, skip: set) -> List[int]:
+    """Pick k distinct candidates, preferring ones outside skip, in O(k) expected draws while skip is small."""
+    if len(skip) == 0:
+        return random.sample(candidates, k)
+
+    picked = []
+    seen = set()
+    attempts = 0
+    max_attempts = 4 * k + len(skip)
+    while len(picked) < k and attempts < max_attempts:
+        attempts += 1
+        recipe_id = candidates[random.randrange(len(candidates))]
+        if recipe_id in skip or recipe_id in seen:
+            continue
+        picked.append(recipe_id)
+        seen.add(recipe_id)
+
+    if len(picked) < k:
+        # Not enough fresh recipes left, fall back to the ones that were meant to be avoided
+        remaining = [recipe_id for recipe_id in candidates if recipe_id not in seen]
+        fresh = [recipe_id for recipe_id in remaining if recipe_id not in skip]
+        stale = [recipe_id for recipe_id in remaining if recipe_id in skip]
+        random.shuffle(fresh)
+        random.shuffle(stale)
+        picked.extend((fresh + stale)[:k - len(picked)])
+
+    return picked
+
+
+planner = MenuPlanner()
+catalog.add_listener(planner.invalidate)
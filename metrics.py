@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from promise import Promise, is_thenable
+
+"""
+Process-wide counters for the GraphQL server, served in the Prometheus text format from /metrics.
+
+Each GraphQL request gets a RequestMetrics (see collect) that MetricsMiddleware, cypher.run, the S3 helpers in utils
+and decode_json add to; it is merged into the process totals once the request finishes, so the hot paths never
+take a lock.  With GRAPHQL_TRACING=1 the per-request numbers, including every resolver's timing in the Apollo
+tracing format, are also returned under extensions.tracing in the GraphQL response.
+"""
+
+TRACING = os.getenv('GRAPHQL_TRACING', '0') == '1'
+
+# Summaries are [count, total seconds] and counters plain numbers, by (metric name, label value)
+_lock = threading.Lock()
+_summaries: Dict[Tuple[str, str], list] = {}
+_counters: Dict[Tuple[str, str], float] = {}
+
+_current: ContextVar[Optional['RequestMetrics']] = ContextVar('request_metrics', default=None)
+
+HELP = {
+    'graphql_request_seconds': ('summary', 'GraphQL requests and their wall time in seconds', None),
+    'graphql_resolver_seconds': ('summary', 'Resolver wall time in seconds by Type.field', 'field'),
+    'graphql_stage_seconds': ('summary', 'Wall time in seconds of the named stages inside resolvers', 'stage'),
+    'cypher_statement_seconds': ('summary', 'Cypher statement time until the database answered', 'statement'),
+    'cypher_rows_total': ('counter', 'Rows read from Cypher statements', 'statement'),
+    's3_calls_total': ('counter', 'S3 API calls by operation', 'operation'),
+    'json_decode_seconds': ('summary', 'Time spent decoding json documents', 'source'),
+    'log_records_total': ('counter', 'Log records by outcome (emitted, sampled_out, dropped)', 'outcome'),
+}
+
+
+class RequestMetrics():
+    def __init__(self, tracing: bool = False):
+        self.tracing = tracing
+        self.start = time.perf_counter()
+        self.start_time = datetime.now(timezone.utc)
+        self.summaries: Dict[Tuple[str, str], list] = {}
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.resolvers = []
+
+    def observe(self, metric: str, label: str, seconds: float):
+        summary = self.summaries.get((metric, label))
+        if summary is None:
+            self.summaries[(metric, label)] = [1, seconds]
+        else:
+            summary[0] += 1
+            summary[1] += seconds
+
+    def count(self, metric: str, label: str, amount: float = 1):
+        self.counters[(metric, label)] = self.counters.get((metric, label), 0) + amount
+
+    def tracing_block(self) -> dict:
+        end = time.perf_counter()
+        statements = sum(count for (metric, _), (count, _) in self.summaries.items()
+                         if metric == 'cypher_statement_seconds')
+        return {
+            'version': 1,
+            'startTime': self.start_time.isoformat(),
+            'endTime': datetime.now(timezone.utc).isoformat(),
+            'duration': int((end - self.start) * 1e9),
+            'execution': {'resolvers': self.resolvers},
+            'cypher': {'statements': statements,
+                       'rows': sum(v for (metric, _), v in self.counters.items() if metric == 'cypher_rows_total')},
+            's3': {'calls': sum(v for (metric, _), v in self.counters.items() if metric == 's3_calls_total')},
+            'jsonDecode': {'duration': int(sum(total for (metric, _), (_, total) in self.summaries.items()
+                                               if metric == 'json_decode_seconds') * 1e9)},
+        }
+
+
+def current() -> Optional[RequestMetrics]:
+    return _current.get()
+
+
+def with_tracing(response):
+    """Add the current request's extensions.tracing block to a formatted GraphQL response when tracing is on."""
+    request_metrics = _current.get()
+    if request_metrics is None or not request_metrics.tracing or not isinstance(response, dict) \
+            or 'data' not in response:
+        return response
+    return dict(response, extensions={'tracing': request_metrics.tracing_block()})
+
+
+def start_request(tracing: bool = None):
+    """Start collecting for the request handled by this thread, returns the token finish_request needs."""
+    return _current.set(RequestMetrics(TRACING if tracing is None else tracing))
+
+
+def finish_request(token):
+    request_metrics = _current.get()
+    _current.reset(token)
+    if request_metrics is None:
+        return
+    request_metrics.observe('graphql_request_seconds', '', time.perf_counter() - request_metrics.start)
+    with _lock:
+        for key, (count, total) in request_metrics.summaries.items():
+            summary = _summaries.setdefault(key, [0, 0.0])
+            summary[0] += count
+            summary[1] += total
+        for key, amount in request_metrics.counters.items():
+            _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def collect(tracing: bool = None):
+    token = start_request(tracing)
+    try:
+        yield _current.get()
+    finally:
+        finish_request(token)
+
+
+def _observe(metric: str, label: str, seconds: float):
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.observe(metric, label, seconds)
+        return
+    with _lock:
+        summary = _summaries.setdefault((metric, label), [0, 0.0])
+        summary[0] += 1
+        summary[1] += seconds
+
+
+def _count(metric: str, label: str, amount: float = 1):
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.count(metric, label, amount)
+        return
+    with _lock:
+        _counters[(metric, label)] = _counters.get((metric, label), 0) + amount
+
+
+def record_statement(name: str, seconds: float):
+    _observe('cypher_statement_seconds', name, seconds)
+
+
+def record_rows(name: str, rows: int):
+    _count('cypher_rows_total', name, rows)
+
+
+def record_s3_call(operation: str):
+    _count('s3_calls_total', operation)
+
+
+def record_log(outcome: str):
+    _count('log_records_total', outcome)
+
+
+def decode_json(document, source: str = 'recipe'):
+    start = time.perf_counter()
+    try:
+        return json.loads(document)
+    finally:
+        _observe('json_decode_seconds', source, time.perf_counter() - start)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block inside a resolver, e.g. the menu sampling in RequestMenu."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe('graphql_stage_seconds', name, time.perf_counter() - start)
+
+
+class CountedResult():
+    """Wraps a neo4j Result to count the rows read from it, see cypher.run."""
+
+    def __init__(self, result, name: str):
+        self._result = result
+        self._name = name
+
+    def __iter__(self):
+        rows = 0
+        try:
+            for record in self._result:
+                rows += 1
+                yield record
+        finally:
+            record_rows(self._name, rows)
+
+    def single(self):
+        record = self._result.single()
+        record_rows(self._name, 0 if record is None else 1)
+        return record
+
+    def __getattr__(self, name):
+        return getattr(self._result, name)
+
+
+class MetricsMiddleware():
+    """Graphene middleware timing every resolver, until its promise resolves for DataLoader backed fields."""
+
+    def resolve(self, next, root, info, **args):
+        request_metrics = _current.get()
+        if request_metrics is None:
+            return next(root, info, **args)
+
+        start = time.perf_counter()
+
+        def record(value):
+            elapsed = time.perf_counter() - start
+            request_metrics.observe('graphql_resolver_seconds', f'{info.parent_type.name}.{info.field_name}', elapsed)
+            if request_metrics.tracing:
+                request_metrics.resolvers.append({
+                    'path': list(info.path), 'parentType': info.parent_type.name, 'fieldName': info.field_name,
+                    'returnType': str(info.return_type), 'startOffset': int((start - request_metrics.start) * 1e9),
+                    'duration': int(elapsed * 1e9)})
+            return value
+
+        result = next(root, info, **args)
+        if is_thenable(result):
+            return Promise.resolve(result).then(record)
+        return record(result)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def exposition() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    with _lock:
+        summaries = dict(_summaries)
+        counters = dict(_counters)
+
+    lines = []
+    for metric, (kind, description, label) in HELP.items():
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} {kind}')
+        if kind == 'summary':
+            for (name, value), (count, total) in sorted(summaries.items()):
+                if name != metric:
+                    continue
+                labels = f'{{{label}="{_escape(value)}"}}' if label is not None else ''
+                lines.append(f'{metric}_count{labels} {count}')
+                lines.append(f'{metric}_sum{labels} {total:.6f}')
+        else:
+            for (name, value), amount in sorted(counters.items()):
+                if name == metric:
+                    lines.append(f'{metric}{{{label}="{_escape(value)}"}} {amount}')
+    return '\n'.join(lines) + '\n'
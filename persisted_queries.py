@@ -0,0 +1,212 @@
+#!venv/bin/python
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Optional
+
+from flask import request
+from graphene_file_upload.flask import FileUploadGraphQLView
+from graphql import parse, validate
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql.language.printer import print_ast
+from graphql_server import HttpQueryError
+
+"""
+Persisted queries for /graphql.
+
+Clients can send the sha256 of a registered document instead of the document itself, using the same request shape
+as Apollo's automatic persisted queries:
+
+    {"variables": {...}, "extensions": {"persistedQuery": {"version": 1, "sha256Hash": "<hex digest>"}}}
+
+Documents are registered from PERSISTED_QUERIES_FILE (a json object of hash -> document, written by
+./persisted_queries.py register <file>...) or, unless PERSISTED_QUERIES_AUTO_REGISTER is 0, the first time a client
+sends a hash together with the document it hashes to.  Auto-registered documents are kept in an LRU of
+PERSISTED_QUERIES_SIZE entries, so clients sending unique documents cannot grow it without bound; documents from the
+file are never evicted.  An unknown hash answers PersistedQueryNotFound so the client can retry with the full document.
+
+Independently of how a document arrives, CachedDocumentBackend keeps the last PERSISTED_QUERY_CACHE_SIZE documents
+parsed and validated, so repeated requests skip straight to execution.
+"""
+
+PERSISTED_QUERY_NOT_FOUND = 'PersistedQueryNotFound'
+
+
+def document_hash(document: str) -> str:
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+class PersistedQueries():
+    def __init__(self, filename: str = None, auto_register: bool = None, max_size: int = None):
+        self.filename = filename if filename is not None else os.getenv('PERSISTED_QUERIES_FILE',
+                                                                         'persisted_queries.json')
+        self.auto_register = auto_register if auto_register is not None else \
+            os.getenv('PERSISTED_QUERIES_AUTO_REGISTER', '1') != '0'
+        self.max_size = max_size if max_size is not None else int(os.getenv('PERSISTED_QUERIES_SIZE', 1024))
+        self._documents: Dict[str, str] = {}
+        self._registered = OrderedDict()
+        self._lock = threading.Lock()
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as file:
+                for digest, document in json.load(file).items():
+                    self.register(document, digest)
+
+    def register(self, document: str, digest: str = None) -> str:
+        """Register a document permanently, as the persisted queries file and the register command do."""
+        digest = self._check(document, digest)
+        with self._lock:
+            self._documents[digest] = document
+        return digest
+
+    def remember(self, document: str, digest: str = None) -> str:
+        """Register a document a client sent, evicting the least recently used ones past max_size."""
+        digest = self._check(document, digest)
+        with self._lock:
+            self._registered[digest] = document
+            self._registered.move_to_end(digest)
+            while len(self._registered) > self.max_size:
+                self._registered.popitem(last=False)
+        return digest
+
+    @staticmethod
+    def _check(document: str, digest: str = None) -> str:
+        if digest is not None and digest != document_hash(document):
+            raise ValueError(f'{digest} is not the sha256 of the given document')
+        return document_hash(document)
+
+    def get(self, digest: str) -> Optional[str]:
+        with self._lock:
+            document = self._documents.get(digest)
+            if document is None:
+                document = self._registered.get(digest)
+                if document is not None:
+                    self._registered.move_to_end(digest)
+            return document
+
+    def resolve(self, params: dict, extensions=None) -> dict:
+        """
+        Fill in the query of one set of request params from its persistedQuery extension, registering the document
+        when it came along with its hash.  Params without the extension are returned untouched.
+        """
+        extensions = extensions if extensions is not None else params.get('extensions')
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpQueryError(400, 'Extensions are invalid JSON.')
+        persisted = (extensions or {}).get('persistedQuery')
+        if persisted is None:
+            return params
+
+        digest = persisted.get('sha256Hash')
+        if params.get('query'):
+            if digest != document_hash(params['query']):
+                raise HttpQueryError(400, 'provided sha does not match query')
+            if self.auto_register and self.get(digest) is None:
+                self.remember(params['query'], digest)
+            return params
+
+        document = self.get(digest)
+        if document is None:
+            raise HttpQueryError(400, PERSISTED_QUERY_NOT_FOUND)
+        return dict(params, query=document)
+
+    def save(self):
+        with self._lock:
+            documents = dict(self._documents)
+        with open(self.filename, 'w') as file:
+            json.dump(documents, file, indent=2, sort_keys=True)
+
+
+def _execute_validated(schema, document_ast, validation_errors, *args, **kwargs):
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+    return execute(schema, document_ast, *args, **kwargs)
+
+
+class CachedDocumentBackend(GraphQLCoreBackend):
+    """GraphQLCoreBackend keeping an LRU of parsed and validated documents, keyed by their text."""
+
+    def __init__(self, max_size: int = None, executor=None):
+        super().__init__(executor=executor)
+        self.max_size = max_size if max_size is not None else int(os.getenv('PERSISTED_QUERY_CACHE_SIZE', 256))
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def document_from_string(self, schema, document_string):
+        if isinstance(document_string, ast.Document):
+            document_string = print_ast(document_string)
+        key = (id(schema), document_string)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                return document
+
+        # Syntax errors raise here and are reported by the caller like any other unparsable document
+        document_ast = parse(document_string)
+        validation_errors = validate(schema, document_ast)
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=partial(_execute_validated, schema, document_ast, validation_errors, **self.execute_params),
+        )
+        # Kept on the document so callers that only inspect it, like the response cache, can skip invalid ones
+        document.validation_errors = validation_errors
+        with self._lock:
+            self._documents[key] = document
+            while len(self._documents) > self.max_size:
+                self._documents.popitem(last=False)
+        return document
+
+
+persisted_queries = PersistedQueries()
+backend = CachedDocumentBackend()
+
+
+def resolve_request(data, query_data=None):
+    """Apply persisted queries to a parsed request body (a single request or a batch) and its query string."""
+    if isinstance(data, list):
+        return [persisted_queries.resolve(params) for params in data]
+    if query_data is not None and 'extensions' in query_data and not data.get('query'):
+        # GET requests carry everything in the query string
+        resolved = persisted_queries.resolve({'query': query_data.get('query')}, query_data['extensions'])
+        return dict(data, query=resolved['query'])
+    return persisted_queries.resolve(data)
+
+
+class PersistedQueryGraphQLView(FileUploadGraphQLView):
+    """FileUploadGraphQLView accepting persisted query hashes and reusing parsed documents."""
+
+    def get_backend(self):
+        return self.backend if self.backend is not None else backend
+
+    def parse_body(self):
+        data = super().parse_body()
+        if not isinstance(data, (dict, list)):
+            # Form bodies come back as an immutable MultiDict
+            data = data.to_dict()
+        return resolve_request(data, request.args)
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] != 'register':
+        print('Usage: ./persisted_queries.py register <document.graphql>...')
+        return
+    for filename in sys.argv[2:]:
+        with open(filename, 'r') as file:
+            digest = persisted_queries.register(file.read())
+        print(f'{digest} {filename}')
+    persisted_queries.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 from datetime import time, datetime
-from database import GraphDB
+import asyncio
+from database import get_async_graph_db, get_graph_db
 from flask import g
 import graphene
 import neo4j
 from neo4j import GraphDatabase, basic_auth
 from graphene_file_upload.scalars import Upload
+from promise import Promise
+from promise.dataloader import DataLoader
+from graphql.language import ast
+import cypher
+import log
+import metrics
 from app_change_log import AppChangeLog
+from recipe_catalog import catalog
+from menu_planner import planner
+from response_cache import responses
+from session_cache import sessions
 import random
 import uuid
 import json
@@ -24,12 +35,50 @@ This file could be broken up into separate files, but most of the time it's just
 the entire schema in a single file while searching/editting.
 """
 
+logger = log.get_logger(__name__)
+
+# Recipes made within this many days are left out of new menus when there are enough others to choose from
+RECENT_RECIPE_DAYS = int(os.getenv('RECENT_RECIPE_DAYS', 14))
+
 
 def get_db():
+    """Session for the current request, borrowed from the shared driver pool and released on teardown."""
     if not hasattr(g, 'neo4j_db'):
-        print("Grabbing a new DB connection")
-        g.neo4j_db = GraphDB()
-    return g.neo4j_db.driver.session()
+        g.neo4j_db = get_graph_db().session()
+    return g.neo4j_db
+
+
+def run_statement(name, parameters=None):
+    """Run a statement from the cypher registry on the current request's session."""
+    return cypher.run(get_db(), name, parameters)
+
+
+def authenticate(session):
+    """The cached account (id, tags, recently made recipes) behind a session token, or None for an invalid session."""
+    account = sessions.get(session)
+    if account is None:
+        account = refresh_session(session)
+    return account
+
+
+def refresh_session(session):
+    """Read the account behind a session from the graph and cache it again, for callers that must not use stale tags."""
+    record = run_statement('session_account', {'session': session, 'recent_days': RECENT_RECIPE_DAYS}).single()
+    if record is None:
+        sessions.invalidate(session)
+        return None
+    return cache_session(session, record)
+
+
+def cache_session(session, record):
+    node = unpack(record.get('a'))
+    tags = {key: value for key, value in node.items() if key.startswith('tag_')}
+    return sessions.put(session, record.get('account_id'), tags, record.get('recent_recipe_ids') or [])
+
+
+def account_params(session, account):
+    """Parameters for the statements that seek the account by its cached id."""
+    return {'account_id': account['id'], 'session': session}
 
 
 class QuestionType(graphene.Enum):
@@ -63,7 +112,7 @@ class SurveyQuestion(graphene.Interface):
     def resolve_type(cls, instance, info):
         # This hack is to accept both cascading json and actual graphene types
         q_type = QuestionType.get(instance['type']) if isinstance(instance, dict) else instance.type
-        print(f'type received: {q_type}')
+        logger.debug('Resolving survey question type', question_type=q_type)
         if q_type == QuestionType.FREE_RESPONSE:
             return FreeResponse
         elif q_type == QuestionType.CHOOSE_MANY:
@@ -74,7 +123,7 @@ class SurveyQuestion(graphene.Interface):
             return Star
         elif q_type == QuestionType.YES_NO:
             return YesNo
-        print("Received unexpected type")
+        logger.warning('Received unexpected survey question type', question_type=q_type)
         return End
 
 
@@ -263,24 +312,42 @@ class Recipe(graphene.ObjectType):
 
     @staticmethod
     def resolve_tags(parent, info):
-        tags = []
-        recipe_id = parent["recipe_id"]
-        print(recipe_id)
-        params = {'recipeId': recipe_id}
-        get_tags_query = 'MATCH (r:Recipe {recipeId: toInteger($recipeId)}) RETURN r LIMIT 1'
-        results = get_db().run(get_tags_query, parameters=params)
-
-        recipe = None
-        for i, record in enumerate(results):
-            recipe = unpack(record.get('r'))
-        
-        if recipe is None:
-            return []
-        
-        for key, value in recipe.items():
-            if key.startswith('tag_'):
-                tags.append({'name': key[len('tag_'):], 'value': value})
-        return tags
+        # Recipes hydrated from r.json already carry their tags, so only fall back to the graph when they don't
+        tags = parent.get('tags')
+        if isinstance(tags, dict):
+            return [{'name': name, 'value': value} for name, value in tags.items()]
+        if any(key.startswith('tag_') for key in parent):
+            return tags_from_properties(parent)
+        return get_recipe_tag_loader().load(int(parent["recipe_id"]))
+
+
+def tags_from_properties(properties):
+    tags = []
+    for key, value in properties.items():
+        if key.startswith('tag_'):
+            tags.append({'name': key[len('tag_'):], 'value': value})
+    return tags
+
+
+class RecipeTagLoader(DataLoader):
+    """Collects every recipe id whose tags are requested while resolving a response and fetches them together."""
+
+    def batch_load_fn(self, recipe_ids):
+        params = {'recipe_ids': recipe_ids}
+        results = run_statement('recipes_by_id', params)
+
+        tags = {}
+        for record in results:
+            tags[record.get('recipe_id')] = tags_from_properties(unpack(record.get('r')))
+
+        return Promise.resolve([tags.get(recipe_id, []) for recipe_id in recipe_ids])
+
+
+def get_recipe_tag_loader():
+    """Loaders cache by key, so they are scoped to a single request."""
+    if not hasattr(g, 'recipe_tag_loader'):
+        g.recipe_tag_loader = RecipeTagLoader()
+    return g.recipe_tag_loader
 
 
 class Menu(graphene.ObjectType):
@@ -296,6 +363,10 @@ class AccountFlags(graphene.ObjectType):
     completed_orientation = graphene.Boolean(default_value=False)
     verified = graphene.Boolean(default_value=False)
 
+    # Flag names SetFlag accepts, mapped to the Flags node property they set
+    FLAGS = {'completed_orientation': 'completed_orientation', 'completedOrientation': 'completed_orientation',
+             'verified': 'verified'}
+
 
 class Account(graphene.ObjectType):
     name = graphene.String()
@@ -316,90 +387,62 @@ class Account(graphene.ObjectType):
 
     @staticmethod
     def resolve_menus(parent, info):
-        params = {'session': parent['session']}
-        check_menus_query = '''MATCH (a:Account {session: $session})-[]-(m: Menu)
-                     CALL {
-                        WITH m MATCH (m)-[]-(r:Recipe) RETURN COLLECT(r) as recipe_list
-                     }
-                     RETURN m, recipe_list'''
-        results = get_db().run(check_menus_query, parameters=params)
-        menus = []
-        for record in results:
-            menu = unpack(record.get('m'))
-            # print(record.get('list'))
-            recipes = [json.loads(recipe['json']) if recipe['json'] is not None else unpack(recipe) for recipe in
-                       record.get('recipe_list')]
-            # print(recipes)
-            menu['recipes'] = recipes
-            # print(menu)
-            menus.append(menu)
-
-        print(menus)
-
+        if 'menus' in parent:
+            return parent['menus']
+        account = authenticate(parent['session'])
+        if account is None:
+            return []
+        menus = get_menus(parent['session'], account)
+        logger.debug('Resolved menus', menus=len(menus))
         return menus
 
     @staticmethod
     def resolve_mastered_skills(parent, info):
-        session = parent['session']
-        query = f'MATCH (a:Account {{session: "{session}"}})-[:HasSkill {{progress' \
-                f': 1}}]-(s:Skill) RETURN count(s) as count'
-        results = get_db().run(query)
+        if 'mastered_skills' in parent:
+            return parent['mastered_skills']
+        account = authenticate(parent['session'])
+        if account is None:
+            return 0
+        params = account_params(parent['session'], account)
+        results = run_statement('account_mastered_skills', params)
         record = results.single()
         mastered_skills = record.get("count") if not None else 0
         return mastered_skills
 
     @staticmethod
     def resolve_meals_made(parent, info):
-        session = parent['session']
-        query = f'MATCH (a:Account {{session: "{session}"}})-[c:Made]-(r:Recipe) RETURN count(c) as meals_made'
-        results = get_db().run(query)
+        if 'meals_made' in parent:
+            return parent['meals_made']
+        account = authenticate(parent['session'])
+        if account is None:
+            return 0
+        params = account_params(parent['session'], account)
+        results = run_statement('account_meals_made', params)
         record = results.single()
         meals_made = record.get("meals_made") if not None else 0
-        print(meals_made)
         return meals_made
 
     @staticmethod
     def resolve_skills(parent, info):
-        session = parent['session']
-        params = {'session': session}
-        query = 'MATCH (a:Account {session: $session}),(s:Skill) OPTIONAL MATCH (a)-[c:HasSkill]->(s) RETURN ' \
-                'COALESCE(c.progress, 0) as progress, s.name as name'
-        results = get_db().run(query, parameters=params)
-        skills = {}
-        for record in results:
-            d = {"progress": record.get("progress") if not None else 0, "name": record.get("name")}
-            if "progress" not in d:
-                d['progress'] = 0
-            skills[d['name']] = d
-
-        get_completed_recipe_skills = '''MATCH (a:Account {session: $session}),
-            (a)-[c:Made]->(r: Recipe)
-            WITH a, c, r CALL {
-                WITH a, c, r
-                UNWIND r.skills as skill
-                RETURN skill
-            }
-            RETURN skill , count(skill) as skill_count
-        '''
-
-        results = get_db().run(get_completed_recipe_skills, parameters=params)
-        for record in results:
-            count = record.get("skill_count")
-            # print(record)
-            skill_name = record.get("skill")
-            # print(f"count: {count}, skill: {skill_name}")
-            if count is not None:
-                skills[skill_name]["progress"] = min(count / 7, 1)
-
-        skills = list(skills.values())
-        return skills
+        if 'skills' in parent:
+            return parent['skills']
+        account = authenticate(parent['session'])
+        if account is None:
+            return []
+        params = account_params(parent['session'], account)
+        # HasSkill progress is kept up to date by CompleteRecipe, so this is a lookup rather than a recount
+        results = run_statement('account_skill_progress', params)
+        return [{"progress": record.get("progress"), "name": record.get("name")} for record in results]
 
     @staticmethod
-    def resolve_flags(parent, info):
-        session = parent['session']
-        query = f'MATCH (a: Account{{session: "{session}"}})-[]->(flags: Flags) RETURN flags'
-        results = get_db().run(query)
-        print("Getting account flags")
+    def resolve_account_flags(parent, info):
+        if 'account_flags' in parent:
+            return parent['account_flags']
+        account = authenticate(parent['session'])
+        if account is None:
+            return {}
+        params = account_params(parent['session'], account)
+        results = run_statement('account_flags', params)
         flags = {}
         for record in results:
             flags = unpack(record.get('flags'))
@@ -415,6 +458,49 @@ def unpack(iterable):
     return results
 
 
+def get_menus(session, account):
+    results = run_statement('account_menus', account_params(session, account))
+    return hydrate_menus(results)
+
+
+def hydrate_menus(results):
+    """
+    Build menu dicts from records of (m, recipe_ids), filling in the recipes in order from the shared catalog.
+    Recipes are the catalog's own dicts rather than copies, so a response holds at most one decoded copy of each.
+    """
+    records = [(unpack(record.get('m')), record.get('recipe_ids')) for record in results]
+    recipes = catalog.get_many(recipe_id for _, recipe_ids in records for recipe_id in recipe_ids)
+    return fill_menus(records, recipes)
+
+
+def fill_menus(records, recipes):
+    menus = []
+    for menu, recipe_ids in records:
+        menu['recipes'] = [recipes[recipe_id] for recipe_id in recipe_ids if recipe_id in recipes]
+        menus.append(menu)
+    return menus
+
+
+def selected_fields(info):
+    """Names of the fields selected directly under the field being resolved, looking through fragments."""
+    names = set()
+
+    def collect(selection_set):
+        if selection_set is None:
+            return
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                names.add(selection.name.value)
+            elif isinstance(selection, ast.InlineFragment):
+                collect(selection.selection_set)
+            elif isinstance(selection, ast.FragmentSpread):
+                collect(info.fragments[selection.name.value].selection_set)
+
+    for field in info.field_asts:
+        collect(field.selection_set)
+    return names
+
+
 class Query(graphene.ObjectType):
     hello = graphene.String(name=graphene.String(default_value="stranger"))
     random = graphene.Float()
@@ -428,20 +514,12 @@ class Query(graphene.ObjectType):
 
     @staticmethod
     def resolve_recipe(parent, info, recipe_id):
-        query = "MATCH (r: Recipe {recipeId: toInteger($recipe_id)}) RETURN r.json AS recipe LIMIT 1"
-        results = get_db().run(query, parameters=({'recipe_id': recipe_id}))
-        recipe = None
-        for item in results:
-            print("Found a result")
-            recipe = item.get('recipe')
-        return json.loads(recipe)
+        return catalog.get(recipe_id)
 
     @staticmethod
     def resolve_survey(root, info, survey_string=None):
         if survey_string is not None:
-            print(survey_string)
-            json_repr = json.loads(survey_string)
-            print(json_repr)
+            json_repr = metrics.decode_json(survey_string, source='survey')
             return json_repr
         free_response = FreeResponse(title="This is a free response question", response="This is the serialized "
                                                                                         "response :)")
@@ -468,16 +546,34 @@ class Query(graphene.ObjectType):
     @staticmethod
     def resolve_presign_object(parent, info, key):
         signed_url = presign_object(key=key)
-        print(signed_url)
+        logger.debug('Presigned object', key=key, ok=signed_url is not None)
         return signed_url
 
     @staticmethod
     def resolve_account(parent, info, session):
-        results = get_db().run(f'MATCH (account:Account {{session: "{session}"}}) RETURN account LIMIT 1')
-        record = None
-        for record in results:
-            print(record)
-        return unpack(record.get("account"))
+        # Compose one statement for every selected Account field, the Account resolvers then read the prefetched
+        # values instead of querying again
+        account = authenticate(session)
+        if account is None:
+            return None
+        name, fields = cypher.account_statement(selected_fields(info))
+        results = run_statement(name, account_params(session, account))
+        record = results.single()
+        if record is None:
+            return None
+
+        account = unpack(record.get("account"))
+        for field in fields:
+            key = cypher.ACCOUNT_FIELD_KEYS[field]
+            if key == 'menus':
+                account[key] = hydrate_menus(record.get(key))
+            elif key == 'skills':
+                account[key] = [dict(skill) for skill in record.get(key)]
+            elif key == 'account_flags':
+                account[key] = unpack(record.get(key)) if record.get(key) is not None else {}
+            else:
+                account[key] = record.get(key)
+        return account
 
     @staticmethod
     def resolve_change_log(parent, info, app_version):
@@ -501,7 +597,7 @@ class SubmitScreenChangeMetrics(graphene.Mutation):
     @staticmethod
     def mutate(root, info, screen_change_metrics):
         # Do something with the screen change metrics
-        print(screen_change_metrics)
+        logger.info('Received screen change metrics', metrics=len(screen_change_metrics))
         ok = True
         return SubmitScreenChangeMetrics(ok=ok)
 
@@ -523,31 +619,30 @@ class Login(graphene.Mutation):
 
     @staticmethod
     def mutate(root, info, email, password_input):
-        print("Fulfilling login request")
-        password_from_db_query = f'MATCH (a:Account {{email: "{email}"}}) RETURN a LIMIT 1'
-        results = get_db().run(password_from_db_query)
+        results = run_statement('account_by_email', {'email': email})
         account = None
         for record in results:
             account = unpack(record.get("a"))
         if account is None:
-            print("Account doesn't exist")
+            logger.info("Login failed, account doesn't exist")
             return Login(ok=False)
 
         if not compare_password(account['password'], password_input):
-            print("Password does not match")
+            logger.info('Login failed, password does not match')
             return Login(ok=False)
 
+        if account.get('session') is not None:
+            sessions.invalidate(account['session'])
+            responses.invalidate_session(account['session'])
         session = uuid.uuid4().hex
 
-        update_session_query = f'MATCH (a:Account {{email: "{email}"}})-[:HasFlags]->(f: Flags) SET a.session = "{session}" ' \
-                               f'RETURN a, f '
-        results = get_db().run(update_session_query)
+        results = run_statement('login_session', {'email': email, 'session': session, 'recent_days': RECENT_RECIPE_DAYS})
         for record in results:
+            cache_session(session, record)
             account = unpack(record.get("a"))
-            account['accountFlags'] = unpack(record.get("f"))
-            print(f"flags: {unpack(record.get('f'))}")
+            account['account_flags'] = unpack(record.get("f"))
 
-        print(f'Logged in account {account}')
+        logger.info('Logged in', email=email)
         return Login(account=account, ok=True, session=session)
 
 
@@ -559,9 +654,9 @@ class Logout(graphene.Mutation):
 
     @staticmethod
     def mutate(root, info, session):
-        query = f'MATCH (a:Account {{session: "{session}"}}) SET a.session = null RETURN a'
-        results = get_db().run(query)
-        print(results)
+        sessions.invalidate(session)
+        responses.invalidate_session(session)
+        results = run_statement('logout', {'session': session})
         account = None
         for record in results:
             account = unpack(record.get("a"))
@@ -569,13 +664,8 @@ class Logout(graphene.Mutation):
 
 
 def account_exists(email: str) -> bool:
-    query = f'MATCH (a:Account {{email: "{email}"}}) RETURN a'
-    results = get_db().run(query)
-    records = 0
-    for _ in results:
-        records += 1
-    exists = False if records == 0 else True
-    return exists
+    results = run_statement('account_exists', {'email': email})
+    return results.single().get('accounts') > 0
 
 
 def password_valid(p: str) -> bool:
@@ -593,17 +683,18 @@ class CompleteRecipe(graphene.Mutation):
 
     @staticmethod
     def mutate(root, info, recipe_id, session, **kwargs):
-        params = {'session': session, 'recipe_id': recipe_id}
-        query = '''MATCH (a: Account {session: $session}), (r: Recipe {recipeId: $recipe_id})
-        CREATE (a)-[c:Made {time: datetime.realtime()}]->(r)
-        RETURN c
-        '''
-
-        results = get_db().run(query, parameters=params)
+        account = authenticate(session)
+        if account is None:
+            return CompleteRecipe(ok=False)
+        params = {**account_params(session, account), 'recipe_id': recipe_id}
+        results = run_statement('complete_recipe', params)
         record = None
         for record in results:
             pass
         ok = False if record is None else True
+        if ok:
+            sessions.put(session, account['id'], account['tags'], account['recent_recipe_ids'] + [recipe_id])
+            responses.invalidate_session(session)
 
         return CompleteRecipe(ok=ok)
 
@@ -621,8 +712,10 @@ class DietaryRestrictions:
         return restriction_tags
 
     @staticmethod
-    def query_tag_text():
-        return ', '.join([f'tag_{r}: $tag_{r}' for r in DietaryRestrictions.restrictions])
+    def tag_updates(tags):
+        """tag_* properties to set from TagInputs, ignoring anything that isn't a known restriction."""
+        allowed = set(DietaryRestrictions.restrictions)
+        return {f'tag_{tag["name"]}': bool(tag["value"]) for tag in tags if tag["name"] in allowed}
 
 
 class CreateAccount(graphene.Mutation):
@@ -638,7 +731,6 @@ class CreateAccount(graphene.Mutation):
 
     @staticmethod
     def mutate(root, info, password_form, restrictions):
-        print(password_form)
         email = password_form['email']
         password_input = password_form['password_input']
         name = password_form['name']
@@ -650,14 +742,12 @@ class CreateAccount(graphene.Mutation):
 
 
         session = uuid.uuid4().hex
-        params = {'email': email, 'name': name, 'password_hash': password_hash, 'session': session, **DietaryRestrictions.query_tag_variables(restrictions)}
-        create_account_query = 'CREATE (a:Account {email: $email, name: $name, password: $password_hash, ' \
-                               'session: $session, verified: false, completedOrientation: false, ' + DietaryRestrictions.query_tag_text() + '}), (f:Flags),' \
-                               '(a)-[c:HasFlags]->(f) return a, c, f'
-
-        results = get_db().run(create_account_query, parameters=params)
+        params = {'email': email, 'name': name, 'password_hash': password_hash, 'session': session,
+                  'tags': DietaryRestrictions.query_tag_variables(restrictions)}
+        results = run_statement('create_account', params)
         account = None
         for record in results:
+            cache_session(session, record)
             account = unpack(record.get("a"))
 
         return CreateAccount(ok=True, code="", session=session, account=account)
@@ -672,24 +762,17 @@ class DeleteAccount(graphene.Mutation):
 
     @staticmethod
     def mutate(root, info, session):
-        delete_account_query = """MATCH (a:Account {session: $session})
-            CALL {
-                WITH a
-                MATCH (a)-[]->(m:Menu)
-                DETACH DELETE m
-                RETURN count(m) as menus 
-            } 
-            DETACH DELETE a 
-            RETURN count(a) as accounts, menus"""
+        sessions.invalidate(session)
+        responses.invalidate_session(session)
         params = dict(session=session)
-        results = get_db().run(delete_account_query, parameters=params)
+        results = run_statement('delete_account', params)
         accounts_deleted = 0
         menus_deleted = 0
         for record in results:
             accounts_deleted = record.get("accounts")
             menus_deleted = record.get("menus")
 
-        print(f'Deleted {accounts_deleted} accounts and {menus_deleted} menus')
+        logger.info('Deleted account', accounts=accounts_deleted, menus=menus_deleted)
         ok = True
         code = ""
         if accounts_deleted != 1:
@@ -725,22 +808,24 @@ class SetDietaryRestrictions(graphene.Mutation):
 
     @staticmethod
     def mutate(self, info, session, restrictions):
-        # TODO put better data sanitization here
-        set_tag_string = ', '.join([f'a.tag_{tag["name"]} = {tag["value"]}' for tag in restrictions])
-        if len(set_tag_string) != 0:
-            set_tag_string = "SET " + set_tag_string
-        params = {'session': session}
-        change_restrictions_query = 'MATCH (a: Account {session: $session}) ' + set_tag_string + ' RETURN a LIMIT 1'
-
-        results = get_db().run(change_restrictions_query, parameters=params)
+        cached = authenticate(session)
+        if cached is None:
+            return SetDietaryRestrictions(ok=False)
+        params = {**account_params(session, cached), 'tags': DietaryRestrictions.tag_updates(restrictions)}
+        results = run_statement('set_account_tags', params)
 
         account = None
         for record in results:
             account = unpack(record.get('a'))
         
         if account is None:
+            sessions.invalidate(session)
             return SetDietaryRestrictions(ok=False)
 
+        sessions.put(session, cached['id'], {k: v for k, v in account.items() if k.startswith('tag_')},
+                     cached['recent_recipe_ids'])
+        responses.invalidate_session(session)
+
         tags = []
         for k, v in account.items():
             if k.startswith('tag_'):
@@ -763,19 +848,16 @@ class Post(graphene.Mutation):
     def mutate(self, info, file: FileStorage, caption: str, public: bool, session: str, recipe_id, **kwargs):
         # TODO upload file to S3, create a Post node with the image access url and caption,
         #   and then link to the person with the given session
+        account = authenticate(session)
+        if account is None:
+            return Post(ok=False)
         ok, key, bucket = upload_to_s3(file, prefix='social_posts')
         if not ok:
             return Post(ok=False)
 
-        params = {'session': session, 'caption': caption, 'public': public, 'key': key, 'bucket': bucket,
-                  'recipe_id': recipe_id}
-        query = '''MATCH (a: Account {session: $session}), (r: Recipe {recipeId: $recipe_id})
-        CREATE (p: Post {caption: $caption, key: $key, bucket: $bucket, public: $public, time: datetime.realtime()}),
-        (a)-[c1:MadePost {time: datetime.realtime(), public: $public}]->(p),
-        (p)-[c2:AboutRecipe]->(r)
-        RETURN p
-        '''
-        results = get_db().run(query, parameters=params)
+        params = {**account_params(session, account), 'caption': caption, 'public': public, 'key': key,
+                  'bucket': bucket, 'recipe_id': recipe_id}
+        results = run_statement('create_post', params)
         record = None
         for record in results:
             continue
@@ -792,8 +874,7 @@ class UploadFile(graphene.Mutation):
 
     @staticmethod
     def mutate(parent, info, file: FileStorage, **kwargs):
-        print(file)
-        print(type(file))
+        logger.debug('Received upload', filename=file.filename)
         # do something with your graphene_file_upload
         # key, local_file = save_file(file)
         #
@@ -816,7 +897,7 @@ class UploadSurvey(graphene.Mutation):
 
     @staticmethod
     def mutate(parent, info, survey, session, **kwargs):
-        print(json.loads(survey))
+        metrics.decode_json(survey, source='survey')
         # TODO tie this to the user's account somehow
         now = datetime.now()
         prefix = f'survey/{now.strftime("%Y-%m-%d")}'
@@ -824,7 +905,7 @@ class UploadSurvey(graphene.Mutation):
         survey_hash = hash(survey)
         key = f'{prefix}/{session}/{survey_hash}'
         ok, key = upload_object(key=key, content=survey_dump)
-        print(key)
+        logger.info('Uploaded survey', key=key, ok=ok)
         return UploadSurvey(ok=ok)
 
 
@@ -839,8 +920,11 @@ class SetFlag(graphene.Mutation):
 
     @staticmethod
     def mutate(parent, info, session, flag, value, **kwargs):
-        query = f'MATCH (a:Account {{"session": {session}}})-[]->(flags:Flags) SET a.{flag} = {value}, return flags'
-        results = get_db().run(query)
+        if flag not in AccountFlags.FLAGS:
+            return SetFlag(ok=False)
+        params = {'session': session, 'flags': {AccountFlags.FLAGS[flag]: value}}
+        results = run_statement('set_account_flags', params)
+        responses.invalidate_session(session)
         flags: dict = {}
         for record in results:
             flags = unpack(record.get('flags'))
@@ -863,101 +947,31 @@ class RequestMenu(graphene.Mutation):
     @staticmethod
     def mutate(parent, info, recipe_count, menu_count, session, override, **kwargs):
         # TODO create a request menu mutation
-        params = {"recipe_count": recipe_count, "menu_count": menu_count, "session": session}
+        account = authenticate(session)
+        if account is None:
+            return RequestMenu(ok=False)
         if not override:
-            check_menus_query = '''MATCH (a:Account {session: $session})-[]-(m: Menu)
-             CALL {
-                WITH m MATCH (m)-[]-(r:Recipe) RETURN COLLECT(r) as list
-             }
-             RETURN m, list'''
-            results: neo4j.Result = get_db().run(check_menus_query, parameters=params)
-            menus = []
-            for record in results:
-                menu = unpack(record.get('m'))
-                # print(record.get('list'))
-                recipes = [json.loads(recipe['json']) if recipe['json'] is not None else unpack(recipe) for recipe in
-                           record.get('list')]
-                # print(recipes)
-                menu['recipes'] = recipes
-                # print(menu)
-                menus.append(menu)
-
-            # print(menus)
+            menus = get_menus(session, account)
+
             if len(menus) > 0:
                 return RequestMenu(ok=True, menus=menus)
-        
-        get_account_query = 'MATCH (a:Account {session: $session}) return a LIMIT 1'
-        results = get_db().run(get_account_query, parameters=params)
-
-        account = None
-        for record in results:
-            account = unpack(record.get('a'))
 
+        # Another server process may have changed the dietary restrictions, so plan against the account as it is now
+        account = refresh_session(session)
         if account is None:
             return RequestMenu(ok=False)
-
-        tags = []
-        for k, v in account.items():
-            if k.startswith('tag_') and v == True:
-                tags.append(k)
-
-        tag_string_filter = ' AND '.join([f'r.{tag} = true' for tag in tags])
-        print(tag_string_filter)
-
-        if len(tag_string_filter) != 0:
-            tag_string_filter = ' AND ' + tag_string_filter
-
-        print(menu_count)
-        query = '''UNWIND range(1, $menu_count) as menu_index
-                WITH menu_index CALL {
-                   MATCH (r:Recipe) WHERE toInteger(r.recipeId) < 1000''' + tag_string_filter + '''
-                   RETURN r.json as recipe, r.recipeId as recipe_id ORDER BY rand() LIMIT $recipe_count
-                }
-                WITH menu_index, recipe, recipe_id CALL {
-                    WITH recipe, recipe_id
-                    RETURN collect(recipe) as recipes, collect(recipe_id) as recipe_ids
-                }
-                RETURN menu_index, recipes, recipe_ids'''
-        recipes = []
-        recipe_ids = []
-        results = get_db().run(query, parameters=params)
-        for record in results:
-            recipes.extend(record.get('recipes'))
-            # print(f'Number of recipe lists: {len(recipes)}')
-            # print(f"Number of recipes in each list: {len(record.get('recipes'))}")
-            recipe_ids.extend(record.get('recipe_ids'))
-            # print(type(recipes[0]))
-            # print(record.get('menu_index'))
-        # print(recipes)
-        # recipe_ids = [json.loads(recipe)['recipe_id'] for recipe in recipes]
-
-        menu_params = {'recipe_ids': recipe_ids, 'menu_count': menu_count, 'session': session}
-        print(recipe_ids)
-        assign_query = '''MATCH (a: Account {session: $session})
-            WITH a
-            UNWIND range(1, $menu_count) AS menu_index
-            CREATE (m: Menu {menu_index: menu_index, time: datetime.realtime()}), (a)-[c:HasMenu]->(m)
-            WITH a, m, $recipe_ids[menu_index] as recipe_ids
-            CALL {
-                WITH m, recipe_ids
-                UNWIND recipe_ids AS id
-                OPTIONAL MATCH (r:Recipe {recipeId: toInteger(id)})
-                CREATE (m)-[c:HasRecipe]->(r)
-                RETURN COLLECT(r) AS recipes
-            }
-            RETURN m, recipes
-        '''
-        results = get_db().run(assign_query, parameters=menu_params)
-        menus = []
-        for record in results:
-            menu = unpack(record.get('m'))
-            # print(record.get('recipes'))
-            # recipes = [json.loads(recipe['json']) if recipe['json'] is not None else unpack(recipe) for recipe in
-            #            record.get('recipes')]
-            # print(len(recipes))
-            menu['recipes'] = [json.loads(recipe) for recipe in recipes[len(menus) * recipe_count:(len(menus) + 1) * recipe_count]]
-            menus.append(menu)
-        # print(menus)
+        tags = [tag for tag, value in account['tags'].items() if value == True]
+
+        with metrics.stage('RequestMenu.plan'):
+            plans = planner.plan(tags, recipe_count, menu_count, avoid=account['recent_recipe_ids'])
+        logger.debug('Planned menus', menus=len(plans), recipes=sum(len(plan) for plan in plans))
+
+        menu_params = {**account_params(session, account),
+                       'menus': [{'menu_index': i + 1, 'recipe_ids': plan} for i, plan in enumerate(plans)]}
+        with metrics.stage('RequestMenu.create_menus'):
+            results = run_statement('create_menus', menu_params)
+            responses.invalidate_session(session)
+            menus = hydrate_menus(results)
         return RequestMenu(ok=True, menus=menus)
 
 
@@ -971,18 +985,15 @@ class UploadRecipeImage(graphene.Mutation):
 
     @staticmethod
     def mutate(parent, info, image, recipe_id, session, **kwargs):
+        account = authenticate(session)
+        if account is None:
+            return UploadRecipeImage(ok=False)
         ok, key, bucket = upload_to_s3(image)
         if not ok:
             return UploadRecipeImage(ok=ok)
 
-        params = {'bucket': bucket, 'key': key, 'recipe_id': recipe_id, 'session': session}
-        query = '''MATCH (a: Account {session: $session}), (r: Recipe {recipeId: $recipe_id})
-        CREATE (node: RecipeImage {key: $key, bucket: $bucket}),
-        (a)-[c1:TookPicture{time: datetime.realtime()}]->(node),
-        (node)-[c2:PictureOf]->(r)
-        RETURN node;
-        '''
-        results = get_db().run(query, parameters=params)
+        params = {**account_params(session, account), 'bucket': bucket, 'key': key, 'recipe_id': recipe_id}
+        results = run_statement('create_recipe_image', params)
 
         record = None
         for record in results:
@@ -1007,7 +1018,7 @@ class UploadFeedback(graphene.Mutation):
     def mutate(parent, info, file, description, tags, feedback_type, state, session, **kwargs):
         # TODO: Upload the screenshot to S3 and then create a json file to represent the
         #       the data that was reported as a result, including the time of upload
-        print('Received feedback!')
+        logger.info('Received feedback', feedback_type=feedback_type)
         ok, key, bucket = upload_to_s3(file)
         if not ok:
             return UploadFeedback(ok=False)
@@ -1053,3 +1064,128 @@ class Mutations(graphene.ObjectType):
 # noinspection PyTypeChecker
 schema = graphene.Schema(query=Query, mutation=Mutations, types=[FreeResponse, YesNo, Star, StarCondition, ChooseOne,
                                                                  ChooseMany, QuestionType, End])
+
+
+# Resolvers for the asyncio execution in asgi.py.  They await statements on the async driver instead of using the
+# request's session on flask's g, so the Account fields selected next to each other run concurrently, each on its own
+# pooled connection.  asgi.py looks them up in ASYNC_RESOLVERS by "ParentType.field"; every other field keeps its
+# resolver above.
+
+async def run_statement_async(name, parameters=None):
+    return await cypher.run_async(get_async_graph_db(), name, parameters)
+
+
+async def authenticate_async(session):
+    account = sessions.get(session)
+    if account is None:
+        records = await run_statement_async('session_account', {'session': session, 'recent_days': RECENT_RECIPE_DAYS})
+        if len(records) == 0:
+            return None
+        account = cache_session(session, records[0])
+    return account
+
+
+async def account_records_async(parent, name):
+    """Records of the account statement name for a resolved Account, or None when its session is no longer valid."""
+    account = await authenticate_async(parent['session'])
+    if account is None:
+        return None
+    return await run_statement_async(name, account_params(parent['session'], account))
+
+
+async def resolve_account_async(parent, info, session):
+    # Only the account node is read here, the selected Account fields then fetch their own values side by side
+    account = await authenticate_async(session)
+    if account is None:
+        return None
+    name, _ = cypher.account_statement([])
+    records = await run_statement_async(name, account_params(session, account))
+    return unpack(records[0].get('account')) if len(records) > 0 else None
+
+
+async def resolve_menus_async(parent, info):
+    if 'menus' in parent:
+        return parent['menus']
+    results = await account_records_async(parent, 'account_menus')
+    if results is None:
+        return []
+    records = [(unpack(record.get('m')), record.get('recipe_ids')) for record in results]
+    # Catalog misses are loaded on the async driver too, so an expired catalog never blocks the loop
+    recipes = await catalog.get_many_async(recipe_id for _, recipe_ids in records for recipe_id in recipe_ids)
+    return fill_menus(records, recipes)
+
+
+async def resolve_mastered_skills_async(parent, info):
+    if 'mastered_skills' in parent:
+        return parent['mastered_skills']
+    records = await account_records_async(parent, 'account_mastered_skills')
+    return records[0].get('count') if records else 0
+
+
+async def resolve_meals_made_async(parent, info):
+    if 'meals_made' in parent:
+        return parent['meals_made']
+    records = await account_records_async(parent, 'account_meals_made')
+    return records[0].get('meals_made') if records else 0
+
+
+async def resolve_skills_async(parent, info):
+    if 'skills' in parent:
+        return parent['skills']
+    records = await account_records_async(parent, 'account_skill_progress')
+    return [] if records is None else [{"progress": record.get("progress"), "name": record.get("name")}
+                                       for record in records]
+
+
+async def resolve_account_flags_async(parent, info):
+    if 'account_flags' in parent:
+        return parent['account_flags']
+    records = await account_records_async(parent, 'account_flags')
+    return unpack(records[-1].get('flags')) if records else {}
+
+
+class AsyncRecipeTagLoader():
+    """RecipeTagLoader for the event loop: ids requested in the same turn of the loop are fetched together."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def load(self, recipe_id):
+        loop = asyncio.get_running_loop()
+        if len(self._pending) == 0:
+            loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        if recipe_id not in self._pending:
+            self._pending[recipe_id] = loop.create_future()
+        return self._pending[recipe_id]
+
+    async def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        try:
+            records = await run_statement_async('recipes_by_id', {'recipe_ids': list(pending)})
+        except Exception as e:
+            for future in pending.values():
+                future.set_exception(e)
+            return
+        tags = {record.get('recipe_id'): tags_from_properties(unpack(record.get('r'))) for record in records}
+        for recipe_id, future in pending.items():
+            future.set_result(tags.get(recipe_id, []))
+
+
+async def resolve_recipe_tags_async(parent, info):
+    tags = parent.get('tags')
+    if isinstance(tags, dict):
+        return [{'name': name, 'value': value} for name, value in tags.items()]
+    if any(key.startswith('tag_') for key in parent):
+        return tags_from_properties(parent)
+    return await info.context.recipe_tag_loader.load(int(parent["recipe_id"]))
+
+
+ASYNC_RESOLVERS = {
+    'Query.account': resolve_account_async,
+    'Account.menus': resolve_menus_async,
+    'Account.masteredSkills': resolve_mastered_skills_async,
+    'Account.mealsMade': resolve_meals_made_async,
+    'Account.skills': resolve_skills_async,
+    'Account.accountFlags': resolve_account_flags_async,
+    'Recipe.tags': resolve_recipe_tags_async,
+}
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from neo4j.exceptions import Neo4jError, ServiceUnavailable
+
+import cypher
+import log
+import metrics
+from database import get_async_graph_db, get_graph_db, unpack
+
+"""
+Process-level cache of parsed recipes keyed by recipeId.
+
+The recipe set is small and only changes through recipe_loader, so the resolvers read recipes from here instead of
+pulling and decoding r.json on every request.  Entries expire after RECIPE_CACHE_TTL seconds and the least recently
+used ones are evicted past RECIPE_CACHE_SIZE entries.  The routes that change a recipe invalidate it explicitly; the
+TTL bounds how stale other server processes can be.
+
+Cached dicts are shared between requests, so callers must treat them as read-only.
+"""
+
+logger = log.get_logger(__name__)
+
+
+class RecipeCatalog():
+    def __init__(self, ttl: float = None, max_size: int = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('RECIPE_CACHE_TTL', 3600))
+        self.max_size = max_size if max_size is not None else int(os.getenv('RECIPE_CACHE_SIZE', 1024))
+        self._recipes = OrderedDict()
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Register a callable run whenever the catalog is warmed, cleared or loses a recipe."""
+        self._listeners.append(listener)
+
+    def _notify(self):
+        for listener in self._listeners:
+            listener()
+
+    def get(self, recipe_id: int) -> Optional[dict]:
+        return self.get_many([recipe_id]).get(int(recipe_id))
+
+    def get_many(self, recipe_ids: Iterable[int]) -> Dict[int, dict]:
+        """Return the requested recipes keyed by id, loading every miss with a single query."""
+        found, missing = self._lookup(recipe_ids)
+        if len(missing) > 0:
+            found.update(self._store(cypher.run(get_graph_db(), 'recipes_by_id', {'recipe_ids': missing})))
+        return found
+
+    async def get_many_async(self, recipe_ids: Iterable[int]) -> Dict[int, dict]:
+        """get_many for the resolvers on asgi.py's event loop, loading misses through the asyncio driver."""
+        found, missing = self._lookup(recipe_ids)
+        if len(missing) > 0:
+            records = await cypher.run_async(get_async_graph_db(), 'recipes_by_id', {'recipe_ids': missing})
+            found.update(self._store(records))
+        return found
+
+    def _lookup(self, recipe_ids: Iterable[int]) -> Tuple[Dict[int, dict], List[int]]:
+        """The cached recipes among recipe_ids keyed by id, and the ids that have to be loaded."""
+        recipe_ids = [int(recipe_id) for recipe_id in recipe_ids]
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for recipe_id in recipe_ids:
+                entry = self._recipes.get(recipe_id)
+                if entry is not None and entry[0] > now:
+                    self._recipes.move_to_end(recipe_id)
+                    found[recipe_id] = entry[1]
+                elif recipe_id not in missing:
+                    missing.append(recipe_id)
+        return found, missing
+
+    def warm(self) -> int:
+        """Load every recipe into the catalog, returning how many were cached."""
+        with self._lock:
+            self._recipes.clear()
+        self._notify()
+        try:
+            loaded = self._store(cypher.run(get_graph_db(), 'all_recipes'))
+        except (ServiceUnavailable, Neo4jError) as e:
+            logger.warning('Could not warm the recipe catalog, recipes will be loaded on demand', error=e)
+            return 0
+        logger.info('Warmed the recipe catalog', recipes=len(loaded))
+        return len(loaded)
+
+    def invalidate(self, recipe_id: int):
+        with self._lock:
+            self._recipes.pop(int(recipe_id), None)
+        self._notify()
+
+    def clear(self):
+        with self._lock:
+            self._recipes.clear()
+        self._notify()
+
+    def _store(self, records) -> Dict[int, dict]:
+        """Cache the recipes of (recipe_id, r) records, returning them keyed by id."""
+        loaded = {}
+        for record in records:
+            node = record.get('r')
+            # Duplicate nodes for the same recipe can exist until recipe_loader merges them, the first one wins
+            if record.get('recipe_id') in loaded:
+                continue
+            loaded[record.get('recipe_id')] = metrics.decode_json(node.get('json')) if node.get('json') is not None else unpack(node)
+
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for recipe_id, recipe in loaded.items():
+                self._recipes[recipe_id] = (expires, recipe)
+                self._recipes.move_to_end(recipe_id)
+            while len(self._recipes) > self.max_size:
+                self._recipes.popitem(last=False)
+
+        return loaded
+
+
+catalog = RecipeCatalog()
@@ -1,207 +1,337 @@
 #!venv/bin/python
+import hashlib
 import json
 import os
 import re
 import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 # from textblob import TextBlob, Word, tokenizers
 
-from neo4j import GraphDatabase, basic_auth
+from database import GraphDB, get_graph_db
 
-if not os.path.exists('.dev'):
-    if os.path.exists('.db_uri'):
-        with open('.db_uri', 'r') as file:
-            os.environ['DB_URI'] = file.read().strip()
-    if os.path.exists('.db_password'):
-        with open('.db_password', 'r') as file:
-            os.environ['DB_PASSWORD'] = file.read().strip()
+"""
+Adds, updates and deletes Recipe nodes (and their Skill nodes) from recipe json files, on the command line and for the
+/recipes/<id>/update and /recipes/<id>/delete routes.
 
-url = os.getenv('DB_URI') if os.getenv('DB_URI') is not None else "bolt://localhost"
-password = os.getenv('DB_PASSWORD') if os.getenv('DB_PASSWORD') is not None else 'memphis-place-optimal-velvet-phantom-127'
+A RecipeLoader writes through the process-wide driver from database.get_graph_db and groups each recipe's statements
+into one explicit write transaction, so a failed write never leaves a recipe half updated.  get_loader() returns the
+loader shared by the process; the module-level functions are shortcuts to it.
+"""
 
-driver = GraphDatabase.driver(url, auth=basic_auth("neo4j", password), encrypted=False)
+# Bulk imports read files on this many threads and write this many recipes per transaction
+IMPORT_WORKERS = int(os.getenv('RECIPE_IMPORT_WORKERS', 8))
+IMPORT_BATCH_SIZE = int(os.getenv('RECIPE_IMPORT_BATCH_SIZE', 100))
 
-neo4j_db = driver.session()
 
-def get_session():
-    if not os.path.exists('.dev'):
-        if os.path.exists('.db_uri'):
-            with open('.db_uri', 'r') as file:
-                os.environ['DB_URI'] = file.read().strip()
-        if os.path.exists('.db_password'):
-            with open('.db_password', 'r') as file:
-                os.environ['DB_PASSWORD'] = file.read().strip()
+def recipe_skills(j) -> list:
+    return sorted({skill['name'].lower() for macro_step in j['steps'] for micro_step in macro_step['steps']
+                   for skill in micro_step['skills']})
 
-    url = os.getenv('DB_URI') if os.getenv('DB_URI') is not None else "bolt://localhost"
-    password = os.getenv('DB_PASSWORD') if os.getenv('DB_PASSWORD') is not None else 'memphis-place-optimal-velvet-phantom-127'
 
-    driver = GraphDatabase.driver(url, auth=basic_auth("neo4j", password), encrypted=False)
+def content_hash(j) -> str:
+    """sha256 of the recipe's canonical json, so formatting and key order don't count as changes."""
+    return hashlib.sha256(json.dumps(j, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
 
-    neo4j_db = driver.session()
-    return neo4j_db
 
+def recipe_properties(j, json_string: str) -> dict:
+    """The Recipe node's properties, as load_recipe and update_recipe write them."""
+    properties = {'recipeId': int(j['recipe_id']), 'recipeName': j['recipe_name'], 'skills': recipe_skills(j),
+                  'json': json_string, 'contentHash': content_hash(j)}
+    properties.update({f'tag_{k}': v for k, v in j['tags'].items()})
+    return properties
 
-def clear_recipes():
-    query = '''
-    MATCH (r:Recipe) WHERE toInteger(r.recipeId) < 1000 DETACH DELETE r RETURN r;
-    '''
-    results = neo4j_db.run(query)
 
+def read_recipe_file(path: str) -> dict:
+    """Read and validate one recipe file; 'error' says what is wrong with it, if anything."""
+    entry = {'path': path, 'error': None}
+    try:
+        with open(path, 'r') as file:
+            json_string = file.read()
+        j = json.loads(json_string)
+        for key in ('recipe_id', 'recipe_name', 'tags', 'steps'):
+            if key not in j:
+                raise ValueError(f'missing {key}')
+        if not isinstance(j['tags'], dict):
+            raise ValueError('tags is not an object')
+        entry['properties'] = recipe_properties(j, json_string)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        entry['error'] = str(e) or type(e).__name__
+    return entry
+
+
+def diff_recipes(tx, entries: list) -> dict:
+    """
+    Sort read recipes into new, changed, unchanged and duplicated ones with a single query comparing content hashes.
+    Nodes written before recipes carried a contentHash count as changed, which gives them one.
+    """
+    query = '''UNWIND $recipe_ids AS recipe_id
+        OPTIONAL MATCH (r:Recipe {recipeId: recipe_id})
+        RETURN recipe_id, count(r) AS nodes, collect(r.contentHash) AS hashes'''
+    results = tx.run(query, parameters={'recipe_ids': [entry['properties']['recipeId'] for entry in entries]})
+    existing = {record.get('recipe_id'): (record.get('nodes'), record.get('hashes')) for record in results}
+
+    diff = {'new': [], 'changed': [], 'unchanged': [], 'duplicated': []}
+    for entry in entries:
+        nodes, hashes = existing.get(entry['properties']['recipeId'], (0, []))
+        if nodes > 1:
+            diff['duplicated'].append(entry)
+        if nodes == 0:
+            diff['new'].append(entry)
+        elif nodes == 1 and hashes == [entry['properties']['contentHash']]:
+            diff['unchanged'].append(entry)
+        else:
+            entry['reason'] = 'duplicated' if nodes > 1 else 'content changed' if len(hashes) > 0 else 'no content hash'
+            diff['changed'].append(entry)
+    return diff
+
+
+def _write_batch(tx, query, properties):
+    tx.run(query, parameters={'recipes': properties}).consume()
+
+
+MERGE_SKILLS = '''UNWIND $skills AS skill
+    MERGE (s:Skill {name: skill})'''
+MERGE_DUPLICATES = '''UNWIND $recipe_ids AS recipe_id
+    MATCH (r:Recipe {recipeId: recipe_id})
+    WITH recipe_id, collect(r) AS nodes, count(r) AS before_count
+    CALL apoc.refactor.mergeNodes(nodes)
+    YIELD node
+    RETURN recipe_id, before_count, count(node) AS after_count'''
+CREATE_RECIPES = '''UNWIND $recipes AS properties
+    CREATE (r:Recipe) SET r = properties'''
+UPDATE_RECIPES = '''UNWIND $recipes AS properties
+    MATCH (r:Recipe {recipeId: properties.recipeId}) SET r = properties'''
+
+
+class RecipeLoader():
+    def __init__(self, graph_db: GraphDB = None):
+        self.graph_db = graph_db if graph_db is not None else get_graph_db()
+
+    @contextmanager
+    def session(self):
+        """Session on the loader's driver, counted by GraphDB and released when the with-block exits."""
+        session = self.graph_db.session()
+        try:
+            yield session
+        finally:
+            self.graph_db.release(session)
+
+    def clear_recipes(self):
+        query = '''
+        MATCH (r:Recipe) WHERE toInteger(r.recipeId) < 1000 DETACH DELETE r
+        '''
+        with self.session() as session:
+            session.execute_write(lambda tx: tx.run(query).consume())
 
-def clear_one_recipe(recipe_id: int) -> bool:
-    parameters = {'recipeId': recipe_id}
-    query = '''
-    MATCH (r:Recipe {recipeId: $recipeId}) DETACH DELETE r RETURN r
-    '''
-    with get_session() as session:
-        results = session.run(query, parameters=parameters)
-        count: int = 0
-        deleted: bool = False
-        for record in results:
-            deleted |= True
-            count += 1
+    def clear_one_recipe(self, recipe_id: int) -> bool:
+        query = '''
+        MATCH (r:Recipe {recipeId: $recipeId}) DETACH DELETE r RETURN count(r) AS count
+        '''
+        with self.session() as session:
+            count = session.execute_write(
+                lambda tx: tx.run(query, parameters={'recipeId': recipe_id}).single().get('count'))
         print(f"Delete {count} recipe duplicate(s) from the database")
-        return deleted
+        return count > 0
 
-
-def load_recipe(json_string: str, is_dict=False):
-    if not is_dict :
-        j = json.loads(json_string)
-    else:
-        j = json_string
-    recipe_id = j['recipe_id']
-    recipe_name = j['recipe_name']
-    tags = j['tags']
-    new_tags = {}
-    for k, v in tags.items():
-        new_tags[f'tag_{k}'] = v
-    tags = new_tags
-    skills = set()
-    for macro_step in j['steps']:
-        for micro_step in macro_step['steps']:
-            for skill in micro_step['skills']:
-                skills.add(skill['name'].lower())
-    skills = list(skills)
-    params = dict()
-    params["recipe_id"] = int(recipe_id)
-    params["recipe_name"] = recipe_name
-    if is_dict:
-        params["json"] = json.dumps(j)
-    else:
-        params["json"] = json_string
-    params["skills"] = skills
-    params.update(tags)
-    tag_string = ', '.join([f'{key}: ${key}' for key, _ in tags.items()])
-    query = "CREATE (r:Recipe {recipeId: $recipe_id, recipeName: $recipe_name, skills: $skills, json: $json, " + tag_string + "}) RETURN r;"
-    with get_session() as session:
-        results = session.run(query, parameters=params)
-
-        session.close()
-
-    with get_session() as session:
-        create_skills_query = '''UNWIND $skills AS skill
-        MERGE (s:Skill {name: skill})
-        RETURN s
+    def load_recipe(self, json_string, is_dict=False):
+        if not is_dict:
+            j = json.loads(json_string)
+        else:
+            j = json_string
+            json_string = json.dumps(j)
+        properties = recipe_properties(j, json_string)
+
+        def write(tx):
+            tx.run(CREATE_RECIPES, parameters={'recipes': [properties]}).consume()
+            tx.run(MERGE_SKILLS, parameters={'skills': properties['skills']}).consume()
+
+        with self.session() as session:
+            session.execute_write(write)
+        print(f'Added {properties["recipeName"]} with skills: {", ".join(properties["skills"])}')
+
+    def merge_recipe(self, recipe_id):
+        with self.session() as session:
+            record = session.execute_write(
+                lambda tx: tx.run(MERGE_DUPLICATES, parameters={'recipe_ids': [recipe_id]}).single())
+        if record is not None:
+            print(f'When updating recipe {recipe_id} before merge instances: {record.get("before_count")} '
+                  f'and now {record.get("after_count")}')
+
+    def update_recipe(self, json_string, is_dict=True) -> str:
+        """Add or update one recipe, skipped when its content hash matches; returns added, updated or unchanged."""
+        if not is_dict:
+            j = json.loads(json_string)
+        else:
+            j = json_string
+            json_string = json.dumps(json_string)
+        properties = recipe_properties(j, json_string)
+        versions_query = "MATCH (r:Recipe {recipeId: $recipe_id}) RETURN r.contentHash AS content_hash"
+
+        def write(tx):
+            versions = [record.get('content_hash') for record in
+                        tx.run(versions_query, parameters={'recipe_id': properties['recipeId']})]
+            if len(versions) > 1:
+                tx.run(MERGE_DUPLICATES, parameters={'recipe_ids': [properties['recipeId']]}).consume()
+            elif len(versions) == 1 and versions[0] == properties['contentHash']:
+                return 'unchanged', versions
+            tx.run(CREATE_RECIPES if len(versions) == 0 else UPDATE_RECIPES,
+                   parameters={'recipes': [properties]}).consume()
+            tx.run(MERGE_SKILLS, parameters={'skills': properties['skills']}).consume()
+            return 'added' if len(versions) == 0 else 'updated', versions
+
+        with self.session() as session:
+            status, versions = session.execute_write(write)
+        if len(versions) > 1:
+            print(f'Merged {len(versions)} instances of recipe {properties["recipeId"]}')
+        if status == 'unchanged':
+            print(f"{j['recipe_name']} in database is already up-to-date")
+        elif status == 'added':
+            print(f"{j['recipe_name']} not in the database yet, added it")
+        else:
+            print(f'Updated the {properties["recipeName"]}')
+        return status
+
+    def import_recipes(self, paths: list, dry_run: bool = False, workers: int = None, batch_size: int = None) -> dict:
+        """
+        Bulk add and update recipe files: read and validate them concurrently, diff them against the database in one
+        query of content hashes, then write the new and changed ones IMPORT_BATCH_SIZE recipes per UNWIND transaction
+        and MERGE all their skills in one more.  Unchanged recipes are skipped without transferring their json.  With
+        dry_run nothing is written.  Returns the diff, with the unreadable files under 'invalid'.
+        """
+        workers = workers or IMPORT_WORKERS
+        batch_size = batch_size or IMPORT_BATCH_SIZE
+
+        entries = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for count, entry in enumerate(executor.map(read_recipe_file, paths), 1):
+                entries.append(entry)
+                if count % 50 == 0 or count == len(paths):
+                    print(f'Read {count}/{len(paths)} recipe files')
+        seen = {}
+        for entry in entries:
+            if entry['error'] is None:
+                recipe_id = entry['properties']['recipeId']
+                if recipe_id in seen:
+                    entry['error'] = f'recipe_id {recipe_id} is also used by {seen[recipe_id]}'
+                else:
+                    seen[recipe_id] = entry['path']
+        invalid = [entry for entry in entries if entry['error'] is not None]
+        entries = [entry for entry in entries if entry['error'] is None]
+        for entry in invalid:
+            print(f'Skipping {entry["path"]}: {entry["error"]}')
+
+        with self.session() as session:
+            diff = session.execute_read(diff_recipes, entries)
+            diff['invalid'] = invalid
+            print(f'{len(diff["new"])} new, {len(diff["changed"])} changed, {len(diff["unchanged"])} unchanged, '
+                  f'{len(diff["duplicated"])} duplicated and {len(invalid)} invalid recipe file(s)')
+            for kind in ('new', 'changed'):
+                for entry in diff[kind]:
+                    properties = entry['properties']
+                    reason = f', {entry["reason"]}' if 'reason' in entry else ''
+                    print(f'  {kind}: {properties["recipeName"]} (recipeId: {properties["recipeId"]}{reason})')
+            if dry_run:
+                print('Dry run, nothing was written')
+                return diff
+
+            if len(diff['duplicated']) > 0:
+                recipe_ids = [entry['properties']['recipeId'] for entry in diff['duplicated']]
+                session.execute_write(
+                    lambda tx: tx.run(MERGE_DUPLICATES, parameters={'recipe_ids': recipe_ids}).consume())
+                print(f'Merged the duplicate nodes of {len(recipe_ids)} recipe(s)')
+
+            writes = [(CREATE_RECIPES, diff['new']), (UPDATE_RECIPES, diff['changed'])]
+            batches = [(query, recipes[i:i + batch_size]) for query, recipes in writes
+                       for i in range(0, len(recipes), batch_size)]
+            for number, (query, batch) in enumerate(batches, 1):
+                session.execute_write(_write_batch, query, [entry['properties'] for entry in batch])
+                print(f'Wrote batch {number}/{len(batches)} ({len(batch)} recipes)')
+
+            skills = sorted({skill for kind in ('new', 'changed') for entry in diff[kind]
+                             for skill in entry['properties']['skills']})
+            if len(skills) > 0:
+                session.execute_write(lambda tx: tx.run(MERGE_SKILLS, parameters={'skills': skills}).consume())
+                print(f'Merged {len(skills)} skill(s)')
+        return diff
+
+    def purge_skills(self, files):
+        skills = set()
+        for file in files:
+            with open(file, 'r') as f:
+                skills.update(recipe_skills(json.loads(f.read())))
+
+        get_current_skills_query = '''MATCH (s:Skill) RETURN s.name AS skill'''
+        remove_skills_query = '''UNWIND $stale_skills AS skill
+        OPTIONAL MATCH (s:Skill {name: skill})
+        DETACH DELETE s
+        RETURN count(s) as count
         '''
-        print(f'Skills parameter: {skills}')
-        results = session.run(create_skills_query, parameters={'skills': skills})
-        print(results.data())
-        session.close()
 
-def merge_recipe(recipe_id):
-    params = {'recipe_id': recipe_id}
-    query = '''MATCH (r:Recipe {recipeId: $recipe_id}) 
-        WITH collect(r) AS nodes, count(r) as before_count
-        CALL apoc.refactor.mergeNodes(nodes)
-        YIELD node
-        RETURN before_count, count(node) as after_count
-    '''
+        with self.session() as session:
+            db_skills = session.execute_read(
+                lambda tx: {record.get('skill').lower() for record in tx.run(get_current_skills_query)})
+            print(f'Skills in the database: {", ".join(db_skills)}')
 
-    with get_session() as session:
-        results = session.run(query, parameters=params)
+            new_skills = list(skills - db_skills)
+            stale_skills = list(db_skills - skills)
+            print(f'Skills in database but not in recipes: {", ".join(stale_skills)}')
+            print(f'Skills in recipe directory but not in database: {", ".join(new_skills)}')
 
-        record = results.single()
-        before_count = record.get("before_count")
-        after_count = record.get("after_count")
+            if len(stale_skills) > 0:
+                print("Purging the stale skills from the database")
+                deleted_skills = session.execute_write(
+                    lambda tx: tx.run(remove_skills_query, parameters={'stale_skills': stale_skills}).single()
+                    .get('count'))
+                print(f'{deleted_skills} skills successfully removed from the database')
 
-        print(f'When updating recipe {recipe_id} before merge instances: {before_count} and now {after_count}')
 
-    return
+_loader = None
+_loader_lock = threading.Lock()
 
 
-def update_recipe(json_string, is_dict=True):
-    if not is_dict:
-        j = json.loads(json_string)
-    else:
-        j = json_string
-        json_string = json.dumps(json_string)
+def get_loader() -> RecipeLoader:
+    """Return the process-wide RecipeLoader, creating it on first use."""
+    global _loader
+    if _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                _loader = RecipeLoader()
+    return _loader
 
-    params = {'recipe_id': int(j["recipe_id"])}
-    equality_query = "MATCH (r:Recipe {recipeId: $recipe_id}) return r as previous_r, r.json as recipe_json"
 
-    recipe_json = None
-    previous_r = None
-    existing_versions = 0
-    with get_session() as session:
-        results = session.run(equality_query, parameters=params)
+def get_session():
+    return get_loader().session()
 
-        for record in results:
-            recipe_json = record.get("recipe_json")
-            previous_r = record.get("previous_r")
-            existing_versions += 1
 
-    if existing_versions > 1:
-        merge_recipe(params['recipe_id'])
+def clear_recipes():
+    get_loader().clear_recipes()
+
+
+def clear_one_recipe(recipe_id: int) -> bool:
+    return get_loader().clear_one_recipe(recipe_id)
 
-    if json_string == recipe_json:
-        print(f"{j['recipe_name']} in database is already up-to-date")
-        return
-    elif previous_r is None:
-        print(f"{j['recipe_name']} not in the database yet, adding it in now")
-        load_recipe(json_string, is_dict=is_dict)
-        return
-    recipe_id = j['recipe_id']
-    recipe_name = j['recipe_name']
-    tags = j['tags']
-    new_tags = {}
-    for k, v in tags.items():
-        new_tags[f'tag_{k}'] = v
-    tags = new_tags
-    tag_string = ', '.join([f'{key}: ${key}' for key, _ in tags.items()])
-    skills = set()
-    for macro_step in j['steps']:
-        for micro_step in macro_step['steps']:
-            for skill in micro_step['skills']:
-                skills.add(skill['name'].lower())
-    skills = list(skills)
-    params = {"recipe_id": int(recipe_id), "recipe_name": recipe_name, "json": json_string, "skills": skills, **tags}
-    query = '''MATCH (r:Recipe {recipeId: $recipe_id})
-                SET r = {recipeId: $recipe_id, recipeName: $recipe_name, skills: $skills, json: $json,
-            '''\
-            + tag_string +\
-            '''
-            }
-                RETURN r.recipeId as recipeId
-            '''
-    with get_session() as session:
-        results = session.run(query, parameters=params)
-
-        r = None
-        for record in results:
-            r = record.get('recipeId')
-            print(f'Updating recipe {r}')
-
-        create_skills_query = '''UNWIND $skills AS skill
-        MERGE (s:Skill {name: skill})
-        RETURN s
-        '''
 
-    with get_session() as session:
-        results = session.run(create_skills_query, parameters={'skills': skills})
+def load_recipe(json_string, is_dict=False):
+    get_loader().load_recipe(json_string, is_dict)
 
-        for record in results:
-            _ = record.get("s")
-        print(f'Updated the {params["recipe_name"]}')
+
+def merge_recipe(recipe_id):
+    get_loader().merge_recipe(recipe_id)
+
+
+def update_recipe(json_string, is_dict=True):
+    return get_loader().update_recipe(json_string, is_dict)
+
+
+def import_recipes(paths: list, dry_run: bool = False, workers: int = None, batch_size: int = None) -> dict:
+    return get_loader().import_recipes(paths, dry_run, workers, batch_size)
+
+
+def purge_skills(files):
+    get_loader().purge_skills(files)
 
 
 # def check_unusual_characters(recipe_text):
@@ -259,55 +389,16 @@ def check_recipe(recipe_json):
         print(f"{recipe_name} is not ready to add to the database")
 
 
-def purge_skills(files):
-    skills = set()
-
-    for file in files:
-        with open(file, 'r') as f:
-            recipe_dict = json.loads(f.read())
-            for macro_step in recipe_dict['steps']:
-                for micro_step in macro_step['steps']:
-                    for skill in micro_step['skills']:
-                        skills.add(skill['name'].lower())
-
-    get_current_skills_query = '''MATCH (s:Skill) RETURN s.name AS skill'''
-
-    with get_session() as session:
-        results = session.run(get_current_skills_query)
-        db_skills = set()
-        for record in results:
-            db_skills.add(record.get('skill').lower())
-
-        print(f'Skills in the database: {", ".join(db_skills)}')
-
-        new_skills = list(skills - db_skills)
-        stale_skills = list(db_skills - skills)
-
-        print(f'Skills in database but not in recipes: {", ".join(stale_skills)}')
-        print(f'Skills in recipe directory but not in database: {", ".join(new_skills)}')
-
-        if len(stale_skills) > 0:
-            print("Purging the stale skills from the database")
-            remove_skills_query = '''UNWIND $stale_skills AS skill
-            OPTIONAL MATCH (s:Skill {name: skill})
-            DETACH DELETE s
-            RETURN count(s) as count
-            '''
-
-            session.run(remove_skills_query, parameters={'stale_skills': stale_skills})
-
-            deleted_skills = 0
-            for record in results:
-                deleted_skills = record.get('count')
-            print(f'{deleted_skills} skills successfully removed from the database')
-
-
 def main():
-    if len(sys.argv) != 3:
-        print('Usage: ./recipe_loader clear|update|add|check recipe_directory')
+    dry_run = '--dry-run' in sys.argv
+    arguments = [argument for argument in sys.argv[1:] if argument != '--dry-run']
+    if len(arguments) != 2 or (dry_run and arguments[0].lower() != 'import'):
+        print('Usage: ./recipe_loader clear|update|add|check|purge_skills recipe_directory')
+        print('       ./recipe_loader import recipe_directory [--dry-run]')
         return
-    command = sys.argv[1]
-    directory = sys.argv[2]
+    command, directory = arguments
+    # One loader, and so one driver, for the whole run
+    loader = get_loader()
     if command.lower() == 'clear':
         print(f'Deleting recipe(s): {directory}')
         if os.path.isfile(directory):
@@ -316,7 +407,7 @@ def main():
                 d = json.loads(json_string)
                 recipe_id = int(d["recipe_id"])
                 print(f'Deleting {d["recipe_name"]} (recipeId: {recipe_id})')
-                clear_one_recipe(recipe_id)
+                loader.clear_one_recipe(recipe_id)
             return
         else:
             abs_directory: str = os.path.abspath(directory)
@@ -329,7 +420,7 @@ def main():
                     d = json.loads(json_string)
                     recipe_id = d["recipeId"]
                     print(f'Deleting {d["recipeName"]} (recipeId: {recipe_id}')
-                    clear_one_recipe(recipe_id)
+                    loader.clear_one_recipe(recipe_id)
 
     elif command.lower() == 'add':
         # print(f'Adding recipe(s): {directory}')
@@ -337,7 +428,7 @@ def main():
             print(f'Adding {"".join(os.path.splitext(directory)[-2:])}')
             with open(directory, 'r') as file:
                 json_string = file.read()
-                load_recipe(json_string)
+                loader.load_recipe(json_string)
             return
         else:
             abs_directory: str = os.path.abspath(directory)
@@ -347,14 +438,14 @@ def main():
             for filename in filenames:
                 with open(os.path.join(directory, filename), 'r') as file:
                     json_string = file.read()
-                    load_recipe(json_string)
+                    loader.load_recipe(json_string)
 
     elif command.lower() == 'update':
         if os.path.isfile(directory):
             print(f'Updating {"".join(os.path.splitext(directory)[-2:])}')
             with open(directory, 'r') as file:
                 json_string = file.read()
-                update_recipe(json_string, is_dict=False)
+                loader.update_recipe(json_string, is_dict=False)
             return
 
         else:
@@ -365,7 +456,7 @@ def main():
             for filename in filenames:
                 with open(os.path.join(directory, filename), 'r') as file:
                     json_string = file.read()
-                    update_recipe(json_string, is_dict=False)
+                    loader.update_recipe(json_string, is_dict=False)
     elif command.lower() == 'check':
         if os.path.isfile(directory):
             print(f'Checking {"".join(os.path.splitext(directory)[-2:])}')
@@ -383,6 +474,14 @@ def main():
                 with open(os.path.join(directory, filename), 'r') as file:
                     json_string = file.read()
                     check_recipe(json_string)
+    elif command.lower() == 'import':
+        if os.path.isfile(directory):
+            paths = [directory]
+        else:
+            _, _, filenames = next(os.walk(directory))
+            paths = [os.path.join(directory, filename) for filename in sorted(filenames) if filename.endswith('.json')]
+        print(f'Importing {len(paths)} recipe file(s) from {directory}')
+        loader.import_recipes(paths, dry_run=dry_run)
     elif command.lower() == 'purge_skills':
         if os.path.isfile(directory):
             print("Expecting a directory of recipes to purge skills.")
@@ -392,10 +491,11 @@ def main():
         print('Fetching skills from all existing recipes')
         filenames = [os.path.join(directory, file) for file in filenames]
 
-        purge_skills(filenames)
+        loader.purge_skills(filenames)
 
     else:
-        print('Usage: ./recipe_loader clear|update|add|check recipe_directory')
+        print('Usage: ./recipe_loader clear|update|add|check|purge_skills recipe_directory')
+        print('       ./recipe_loader import recipe_directory [--dry-run]')
         return
 
 
@@ -1,66 +1,76 @@
 import html
 import json
 import re
-from sheets_reader import GoogleSheetsReader
+import threading
+from sheets_reader import GoogleSheetsReader, SheetSnapshot
 
 class RecipeParser:
-    def __init__(self):
+    """
+    Reads recipes from the recipes sheet.  In snapshot mode the whole sheet is kept in memory (and on disk) and only
+    read again once its revision changes, see sheets_reader.SheetSnapshot; otherwise every call reads the sheet.
+    """
+
+    def __init__(self, snapshot=False):
         self.sheets_reader = GoogleSheetsReader()
+        self.snapshot = SheetSnapshot(self.sheets_reader, 'recipes') if snapshot else None
+
+    def iter_recipe_names(self):
+        """Yield {'id', 'name'} for every recipe, paging through the sheet unless it's a snapshot."""
+        if self.snapshot is not None:
+            rows = self.snapshot.get()
+            if len(rows) == 0:
+                return
+            id_column, name_column = rows[0].index('Recipe ID'), rows[0].index('Recipe Name')
+            for row in rows[1:]:
+                if id_column < len(row) and name_column < len(row):
+                    yield {'id': row[id_column], 'name': row[name_column]}
+            return
+        for id, name in self.sheets_reader.iter_columns('recipes', ['Recipe ID', 'Recipe Name']):
+            if id != '' and name != '':
+                yield {'id': id, 'name': name}
 
     def get_recipe_names(self):
-        recipe_ids = self.sheets_reader.read_column('recipes', 'Recipe ID')
-        recipe_names = self.sheets_reader.read_column('recipes', 'Recipe Name')
-        return [{'id': id, 'name': name} for id, name in zip(recipe_ids, recipe_names)]
+        return list(self.iter_recipe_names())
+
+    def find_recipe_row(self, column_name, value, check=False):
+        if self.snapshot is not None:
+            return self.snapshot.find_row(column_name, value, check)
+        return self.sheets_reader.find_row('recipes', column_name, value)
 
-    def get_recipe(self, recipe_name=None, recipe_id=None):
-        index = 1
+    def get_recipe(self, recipe_name=None, recipe_id=None, check=False):
+        """check=True makes a snapshot look for a newer revision now, for callers that must not get stale data."""
         if recipe_name is not None:
-            recipe_names = self.sheets_reader.read_column('recipes', 'Recipe Name')
-            # print(f'Recipe name list: {recipe_names}')
-            index = recipe_names.index(recipe_name) + 1
+            recipe_data = self.find_recipe_row('Recipe Name', recipe_name, check)
         elif recipe_id is not None:
-            recipe_ids = self.sheets_reader.read_column('recipes', 'Recipe ID')
-            print(f'Recipe ID list, looking for {recipe_id}: {recipe_ids}')
-            # Account for 1 indexing + the header row
-            index = recipe_ids.index(str(recipe_id)) + 2
-
-        recipe_data = self.sheets_reader.read_row_from_source('recipes', index, as_dict=True)
+            recipe_data = self.find_recipe_row('Recipe ID', str(recipe_id), check)
+        else:
+            recipe_data = self.sheets_reader.read_row_from_source('recipes', 1, as_dict=True)
 
         return parse_recipe(recipe_data)
 
 
-def parse_macro_instructions(instructions):
-  # print("Printing instructions")
-  # print(instructions)
-  macro_list = []
-  brace_depth = 0
-  for i, c in enumerate(instructions):
-    if c == '{': 
-      brace_depth += 1
-    elif c == '}':
-      brace_depth -= 1
-    if c == '-' and brace_depth == 0:
-      macro_list.append(i)
-  macro_list.append(len(instructions))
-  macro_instructions = [instructions[macro_list[i] + 1:macro_list[i + 1]].strip() for i in range(0, len(macro_list) - 1)]
-  macro_instructions = list(filter(lambda li: len(li) > 5, macro_instructions))
-  # print(f'brace depth: {brace_depth}')
-  return macro_instructions
-
-def parse_micro_instructions(macro_instruction):
-  micro_list = [0]
-  brace_depth = 0
-  for i, c in enumerate(macro_instruction):
-    if c == '{': 
-      brace_depth += 1
-    elif c == '}':
-      brace_depth -= 1
-    if c == ',' and brace_depth == 0:
-      micro_list.append(i)
-  micro_list.append(len(macro_instruction))
-  micro_instructions = [macro_instruction[micro_list[i]:micro_list[i + 1]].strip()[1:] for i in range(0, len(micro_list) - 1)]
-  micro_instructions = list(filter(lambda li: len(li) > 5, micro_instructions))
-  return micro_instructions
+_shared_parser = None
+_shared_parser_lock = threading.Lock()
+
+
+def get_recipe_parser() -> RecipeParser:
+    """Return the process-wide snapshot mode RecipeParser, creating it on first use."""
+    global _shared_parser
+    if _shared_parser is None:
+        with _shared_parser_lock:
+            if _shared_parser is None:
+                _shared_parser = RecipeParser(snapshot=True)
+    return _shared_parser
+
+
+class InstructionSyntaxError(ValueError):
+  """A malformed recipe instruction string, with the 1-based line and column of the problem."""
+
+  def __init__(self, message, text, index):
+    self.line = text.count('\n', 0, index) + 1
+    self.column = index - (text.rfind('\n', 0, index) + 1) + 1
+    super().__init__(f'{message} at line {self.line}, column {self.column}')
+
 
 def parse_skills(skills):
   return [{'name': skill.strip()} for skill in filter( lambda s: s != "empty", skills.split(','))]
@@ -75,76 +85,145 @@ def strip_parentheses(string: str):
     string = string[0: -1]
   return string
 
-def parse_ingredients(ingredients):
-  ingredient_list = []
-  open_found = 0
-  brace_depth = 0
-  for i, c in enumerate(ingredients):
-    if c == '{': 
-      open_found = i
-    elif c == '}':
-      cluster = ingredients[open_found + 1: i]
-      if len(cluster) < 2:
-        continue
-      tokens = [token.strip() for token in cluster.split(',')]
-      if len(tokens) < 3:
-        continue
-      ingredient_list.append({"name": tokens[0], "quantity": float(tokens[1]), "unit": tokens[2], "new": len(tokens) > 3})
-
-  return ingredient_list
-
-def parse_equipment(ingredients):
-  ingredient_list = []
-  open_found = 0
-  brace_depth = 0
-  for i, c in enumerate(ingredients):
-    if c == '{': 
-      open_found = i
-    elif c == '}':
-      cluster = ingredients[open_found + 1: i]
-      if len(cluster) < 2:
-        continue
-      # print(cluster)
-      tokens = [token.strip() for token in cluster.split(',')]
-      if len(tokens) < 2:
-        continue
-      ingredient_list.append({"name": tokens[0], "quantity": float(tokens[1])})
-
-  return ingredient_list
-
-def parse_instruction_step(instruction):
-  token_indices = [0]
-  brace_depth = 0
-  for i, c in enumerate(instruction):
-    if c == '(': 
-      brace_depth += 1
-    elif c == ')':
-      brace_depth -= 1
-    if c == ',' and brace_depth == 0:
-      token_indices.append(i)
-
-  token_indices.append(len(instruction))
-  attributes = [instruction[token_indices[i]:token_indices[i + 1]].strip()[1:] for i in range(0, len(token_indices) - 1)]
+def _cluster_tokens(text, span, minimum):
+  open_index, close_index = span
+  if open_index is None:
+    raise InstructionSyntaxError("'}' without a matching '{'", text, close_index)
+  cluster = text[open_index + 1:close_index]
+  if len(cluster) < 2:
+    return None
+  tokens = [token.strip() for token in cluster.split(',')]
+  if len(tokens) < minimum:
+    return None
+  try:
+    float(tokens[1])
+  except ValueError:
+    raise InstructionSyntaxError(f"Quantity '{tokens[1]}' is not a number", text, open_index + 1)
+  return tokens
+
+def _build_step(text, step_index, attributes, clusters):
+  """One micro step from its attribute spans and the {...} spans of its equipment and ingredients."""
+  if len(attributes) < 4:
+    raise InstructionSyntaxError(f'Expected (skills), (equipment), (ingredients) and (text) but found '
+                                 f'{len(attributes)} attribute(s) in the step', text, step_index)
+  values = [text[start:end].strip()[1:] for start, end in attributes]
+  equipment = []
+  for span in clusters[1]:
+    tokens = _cluster_tokens(text, span, 2)
+    if tokens is not None:
+      equipment.append({"name": tokens[0], "quantity": float(tokens[1])})
+  ingredients = []
+  for span in clusters[2]:
+    tokens = _cluster_tokens(text, span, 3)
+    if tokens is not None:
+      ingredients.append({"name": tokens[0], "quantity": float(tokens[1]), "unit": tokens[2], "new": len(tokens) > 3})
   time_estimate = None
-  # print(attributes)
-  skills = strip_parentheses(attributes[0])
-  equipment = strip_parentheses(attributes[1])
-  ingredients = strip_parentheses(attributes[2])
-  flavor_text = strip_parentheses(attributes[3])
-  if len(attributes) >= 5:
-    time_estimate = re.sub(r'[^0-9]', '', attributes[4])
+  if len(values) >= 5:
+    time_estimate = re.sub(r'[^0-9]', '', values[4])
     if len(time_estimate) > 0:
       time_estimate = int(time_estimate)
-  return {'skills': parse_skills(skills), 'equipment': parse_equipment(equipment), 'ingredients': parse_ingredients(ingredients), 'flavor_text': flavor_text, 'time_estimate': time_estimate}
-
-def parse_all(instructions_list):
-  res = []
-  for macro_step in parse_macro_instructions(instructions_list):
-    micro_steps = []
-    for micro_step in parse_micro_instructions(macro_step):
-      micro_steps.append(parse_instruction_step(micro_step))
-    res.append(micro_steps)
-  return res
+  return {'skills': parse_skills(strip_parentheses(values[0])), 'equipment': equipment, 'ingredients': ingredients,
+          'flavor_text': strip_parentheses(values[3]), 'time_estimate': time_estimate}
+
+class _MicroStep():
+  """Spans of the micro step being scanned, start is its first character, which the grammar skips."""
+
+  def __init__(self, start):
+    self.start = start
+    self.last = start
+    self.attributes = [[start + 1, None]]
+    self.clusters = {1: [], 2: []}
+    self.cluster_open = None
+    self.parens = []
+    self.error = None
+
+  def add(self, text, index, c):
+    self.last = index
+    if c == '(':
+      self.parens.append(index)
+    elif c == ')':
+      if len(self.parens) > 0:
+        self.parens.pop()
+      elif self.error is None:
+        self.error = InstructionSyntaxError("Unmatched ')'", text, index)
+    elif c == ',' and len(self.parens) == 0:
+      self.attributes[-1][1] = index
+      self.attributes.append([index, None])
+      self.cluster_open = None
+    elif len(self.attributes) in (2, 3):
+      if c == '{':
+        self.cluster_open = index
+      elif c == '}':
+        self.clusters[len(self.attributes) - 1].append((self.cluster_open, index))
+        self.cluster_open = None
+
+  def build(self, text):
+    """The parsed step, or None for steps of up to 5 characters (after the first), which are skipped."""
+    if self.last - self.start <= 5:
+      return None
+    if self.error is not None:
+      raise self.error
+    if len(self.parens) > 0:
+      raise InstructionSyntaxError("Unclosed '('", text, self.parens[-1])
+    self.attributes[-1][1] = self.last + 1
+    return _build_step(text, self.start, self.attributes, self.clusters)
+
+
+def parse_all(instructions):
+  """
+  Parse a recipe's instructions into a list of macro steps, each a list of micro steps, in one scan.
+
+  The grammar is `-{(skills),(equipment),(ingredients),(text),(time)}, {...} -{...}`: a '-' outside braces starts a
+  macro step, a ',' outside braces starts a micro step and a ',' outside parentheses starts an attribute.  Equipment
+  is `{name, quantity}` and ingredients `{name, quantity, unit[, new]}`.  Macro steps of up to 5 characters and micro
+  steps of up to 5 characters after their opening one are skipped.  Malformed input raises InstructionSyntaxError.
+  """
+  result = []
+  braces = []
+  macro = None
+  macro_first = macro_last = None
+  micro = None
+
+  def close_macro():
+    if micro is not None:
+      step = micro.build(instructions)
+      if step is not None:
+        macro.append(step)
+    if macro_first is not None and macro_last - macro_first >= 5:
+      result.append(macro)
+
+  for index, c in enumerate(instructions):
+    if c == '{':
+      braces.append(index)
+    elif c == '}':
+      if len(braces) == 0:
+        raise InstructionSyntaxError("Unmatched '}'", instructions, index)
+      braces.pop()
+    elif c == '-' and len(braces) == 0:
+      if macro is not None:
+        close_macro()
+      macro, macro_first, macro_last, micro = [], None, None, None
+      continue
+
+    if macro is None or c.isspace():
+      continue
+    if macro_first is None:
+      macro_first = index
+    macro_last = index
+    if micro is None or (c == ',' and len(braces) == 0):
+      if micro is not None:
+        step = micro.build(instructions)
+        if step is not None:
+          macro.append(step)
+      micro = _MicroStep(index)
+    else:
+      micro.add(instructions, index, c)
+
+  if len(braces) > 0:
+    raise InstructionSyntaxError("Unclosed '{'", instructions, braces[-1])
+  if macro is not None:
+    close_macro()
+  return result
 
 def get_ingredient_name(ingredient):
   # print(ingredient)
@@ -156,47 +235,74 @@ def get_ingredient_name(ingredient):
 def get_equipment_name(equipment):
   return f'{equipment["quantity"]} {equipment["name"]}{"s" if float(equipment["quantity"]) != 1 else ""}'
 
+PLACEHOLDER = re.compile(r'\{([^}]*)\}')
+
+
+class FlavorTextError(ValueError):
+  """A {i|e, text, index} placeholder in a step's flavor text that can't be filled."""
+
+
+def _placeholder_context(flavor_text, start, end):
+  return f'...{flavor_text[max(start - 20, 0):end + 20]}...'
+
 def flavor_text_to_html(ingredients, equipment, flavor_text):
-  text = ""
-  step_plain_text = ''
-  ptr = 0
-  # print(ingredients)
-  # print(equipment)
-  error_message = ''
-  try:
-    while ptr < len(flavor_text):
-      if flavor_text[ptr] == '{':
-        forward_ptr = ptr + 1
-        while flavor_text[forward_ptr] != '}':
-          forward_ptr += 1
-        tokens = [token.strip() for token in flavor_text[ptr + 1:forward_ptr].split(',')]
-        # print(tokens)
-        isIngredient = tokens[0] == 'i'
-        ingredient_index = int(tokens[2]) - 1
-        plain_text = tokens[1]
-        step_plain_text += plain_text
-        error_message = f'Tried to find an {"Ingredient" if isIngredient else "Equipment"} at entry index {ingredient_index + 1} of {ingredients if isIngredient else equipment}, to fill ...{flavor_text[ptr - 20:forward_ptr + 20]}...'
-        # print(ingredient_index)
-        # print(ingredients)
-        # print(equipment)
-        # print(flavor_text)
-        # print(plain_text)
-        hover_text = get_ingredient_name(ingredients[ingredient_index]) if isIngredient else f'{equipment[ingredient_index]["name"]} {equipment[ingredient_index]["quantity"]}'
-        color = "color:green" if isIngredient else "color:red"
-        text += f'<span title="{hover_text}" style="{color};white-space:nowrap;">{plain_text}</span>'
-        ptr = forward_ptr + 1
+  """The step as an <li> with its placeholders highlighted, and as plain text, in one pass over the flavor text."""
+  html_parts = ['<li>']
+  plain_parts = []
+  position = 0
+  for match in PLACEHOLDER.finditer(flavor_text):
+    text = flavor_text[position:match.start()]
+    html_parts.append(text)
+    plain_parts.append(text)
+    position = match.end()
+
+    tokens = [token.strip() for token in match.group(1).split(',')]
+    is_ingredient = tokens[0] == 'i'
+    if len(tokens) < 3:
+      raise FlavorTextError(f'Expected {{i|e, text, index}} but found {match.group(0)} to fill '
+                            f'{_placeholder_context(flavor_text, match.start(), match.end())}')
+    try:
+      index = int(tokens[2]) - 1
+    except ValueError:
+      raise FlavorTextError(f"Index '{tokens[2]}' is not a whole number, to fill "
+                            f'{_placeholder_context(flavor_text, match.start(), match.end())}')
+    plain_text = tokens[1]
+    try:
+      if is_ingredient:
+        hover_text = get_ingredient_name(ingredients[index])
       else:
-        text += flavor_text[ptr]
-        step_plain_text += flavor_text[ptr]
-        ptr += 1
-  except IndexError as e:
-    print(e)
-    raise Exception(error_message)
-  return f'<li>{text}</li>', step_plain_text
+        hover_text = f'{equipment[index]["name"]} {equipment[index]["quantity"]}'
+    except IndexError:
+      raise FlavorTextError(f'Tried to find an {"Ingredient" if is_ingredient else "Equipment"} at entry index '
+                            f'{index + 1} of {ingredients if is_ingredient else equipment}, to fill '
+                            f'{_placeholder_context(flavor_text, match.start(), match.end() - 1)}')
+    color = "color:green" if is_ingredient else "color:red"
+    html_parts.append(f'<span title="{hover_text}" style="{color};white-space:nowrap;">{plain_text}</span>')
+    plain_parts.append(plain_text)
+
+  text = flavor_text[position:]
+  if '{' in text:
+    start = position + text.index('{')
+    raise FlavorTextError(f"Unclosed '{{' in {_placeholder_context(flavor_text, start, len(flavor_text))}")
+  html_parts.append(text)
+  html_parts.append('</li>')
+  plain_parts.append(text)
+  return ''.join(html_parts), ''.join(plain_parts)
 
 def print_recipe(micro_step):
   return flavor_text_to_html(micro_step["ingredients"], micro_step["equipment"], micro_step["flavor_text"])
 
+def render_steps(parsed_recipe):
+  """Render every micro step of a parse_all result, filling in its "text"; the <li> html grouped by macro step."""
+  rendered = []
+  for macro_step in parsed_recipe:
+    macro_html = []
+    for micro_step in macro_step:
+      html_text, micro_step["text"] = print_recipe(micro_step)
+      macro_html.append(html_text)
+    rendered.append(macro_html)
+  return rendered
+
 def parse_recipe(recipe_dict, write_to_file=True, display_html=True):
   recipe_id = recipe_dict['Recipe ID']
   instructions_list = recipe_dict['Instructions']
@@ -205,10 +311,7 @@ def parse_recipe(recipe_dict, write_to_file=True, display_html=True):
   parsed_recipe = parse_all(instructions_list)
   ingredients_list = {}
   equipment_list = {}
-  steps = []
   skills = set()
-  macro_step = None
-  micro_step = None
   time_estimate = parsed_recipe[-1][-1]["time_estimate"]
   time_estimate = time_estimate if time_estimate != 0 else None
   recipe_json = {'steps':  [], 'recipe_name': recipe_name, 'description': blurb,\
@@ -218,43 +321,35 @@ def parse_recipe(recipe_dict, write_to_file=True, display_html=True):
     if value == 'y' or value == 'n':
         recipe_json['tags'][header.lower()] = True if value == 'y' else False
 
-  try:
-    for macro_step in parsed_recipe:
-      # print("Formatting next macro step")
-      step = []
-      micro_step_list = []
-      for micro_step in macro_step:
-        # print("Formatting next micro step")
-        html_text, micro_step["text"] = print_recipe(micro_step)
-        step.append(html_text)
-        for skill in micro_step["skills"]:
-          skills.add(skill["name"])
-        for ingredient in micro_step["ingredients"]:
-          if ingredient["name"] in ingredients_list and ingredient["new"]:
-            current = float(ingredients_list[ingredient["name"]]["quantity"])
-            print(current)
-            ingredients_list[ingredient["name"]]["quantity"] = float(ingredient["quantity"]) + current
-          else:
-            ingredients_list[ingredient["name"]] = ingredient
-        for equipment in micro_step["equipment"]:
-            equipment_list[equipment["name"]] = equipment
-        micro_step_list.append(micro_step)
-      steps.append(step)
-      recipe_json['steps'].append({'steps': micro_step_list, 'name': ''})
-    for _, v in equipment_list.items():
-      v["quantity"] = f'{v["quantity"]:.2g}'
-    for k, v in ingredients_list.items():
-      v["quantity"] = f'{v["quantity"]:.2g}'
-    recipe_json['equipment'] = list(equipment_list.values())
-    recipe_json['ingredients'] = list(ingredients_list.values())
-    
-    file_recipename = re.sub("\W", "", recipe_json["recipe_name"])
-    filename = f'recipes/{file_recipename}_{recipe_json["recipe_id"]}.json'
-
-  except Exception as e:
-    print(e)
-    # print(micro_step)
-    raise Exception(f'Error when formatting step: {micro_step}')
+  steps = render_steps(parsed_recipe)
+  for macro_step in parsed_recipe:
+    # print("Formatting next macro step")
+    micro_step_list = []
+    for micro_step in macro_step:
+      # print("Formatting next micro step")
+      for skill in micro_step["skills"]:
+        skills.add(skill["name"])
+      for ingredient in micro_step["ingredients"]:
+        if ingredient["name"] in ingredients_list and ingredient["new"]:
+          current = float(ingredients_list[ingredient["name"]]["quantity"])
+          print(current)
+          ingredients_list[ingredient["name"]]["quantity"] = float(ingredient["quantity"]) + current
+        else:
+          ingredients_list[ingredient["name"]] = ingredient
+      for equipment in micro_step["equipment"]:
+          equipment_list[equipment["name"]] = equipment
+      micro_step_list.append(micro_step)
+    recipe_json['steps'].append({'steps': micro_step_list, 'name': ''})
+  for _, v in equipment_list.items():
+    v["quantity"] = f'{v["quantity"]:.2g}'
+  for k, v in ingredients_list.items():
+    v["quantity"] = f'{v["quantity"]:.2g}'
+  recipe_json['equipment'] = list(equipment_list.values())
+  recipe_json['ingredients'] = list(ingredients_list.values())
+  
+  file_recipename = re.sub("\W", "", recipe_json["recipe_name"])
+  filename = f'recipes/{file_recipename}_{recipe_json["recipe_id"]}.json'
+
 
   return recipe_json, f'''
   <h1>{recipe_name}</h1>
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set
+
+from flask import Response, g, request
+from graphql.language import ast
+from graphql.language.printer import print_ast
+from graphql.type import GraphQLList, GraphQLNonNull
+from graphql_server import HttpQueryError, get_graphql_params, json_encode
+
+import metrics
+from persisted_queries import PersistedQueryGraphQLView, backend
+from recipe_catalog import catalog
+
+"""
+Opt-in cache of serialized /graphql responses for read-only operations.
+
+Set RESPONSE_CACHE=1 to turn it on.  Only query operations whose every root field has a TTL hint in CACHE_HINTS are
+cached, keyed by the normalized document, operation name and variables (which carry the session).  A field's TTL is
+the smallest hint on its path, so nested fields only need a hint when they go stale sooner than their parent.
+Responses with errors are never cached.
+
+Mutations that change what an account reads call invalidate_session, and any change to the recipe catalog drops
+every entry.  Other server processes only see their own invalidations, so hints also bound how stale they can be.
+"""
+
+# Seconds a field may be served from the cache, by "ParentType.field"
+CACHE_HINTS: Dict[str, int] = {
+    'Query.hello': 3600,
+    'Query.recipe': 3600,
+    'Query.survey': 3600,
+    'Query.changeLog': 3600,
+    'Query.account': 300,
+    'Account.menus': 300,
+}
+
+
+class CachePlan(NamedTuple):
+    key: str
+    max_age: int
+    sessions: Set[str]
+
+
+def _named_type(graphql_type):
+    while isinstance(graphql_type, (GraphQLList, GraphQLNonNull)):
+        graphql_type = graphql_type.of_type
+    return graphql_type
+
+
+def _argument_value(value, variables):
+    if isinstance(value, ast.Variable):
+        return variables.get(value.name.value)
+    return getattr(value, 'value', None)
+
+
+def _walk(schema, parent_type, selection_set, fragments, variables, max_age, sessions, root=False) -> Optional[int]:
+    """Smallest TTL reached under selection_set, or None when a root field has no hint."""
+    for selection in selection_set.selections:
+        if isinstance(selection, ast.FragmentSpread):
+            fragment = fragments.get(selection.name.value)
+            fragment_type = schema.get_type(fragment.type_condition.name.value) if fragment is not None else None
+            if fragment_type is None:
+                return None
+            max_age = _walk(schema, fragment_type, fragment.selection_set, fragments, variables, max_age, sessions, root)
+        elif isinstance(selection, ast.InlineFragment):
+            fragment_type = schema.get_type(selection.type_condition.name.value) if selection.type_condition \
+                else parent_type
+            if fragment_type is None:
+                return None
+            max_age = _walk(schema, fragment_type, selection.selection_set, fragments, variables, max_age, sessions,
+                            root)
+        else:
+            name = selection.name.value
+            if name == '__typename':
+                continue
+            hint = CACHE_HINTS.get(f'{parent_type.name}.{name}')
+            if hint is None and root:
+                return None
+            field_age = max_age if hint is None else min(max_age, hint)
+
+            for argument in selection.arguments or []:
+                if argument.name.value == 'session':
+                    sessions.add(_argument_value(argument.value, variables))
+
+            field = getattr(parent_type, 'fields', {}).get(name)
+            if selection.selection_set is not None and field is not None:
+                field_age = _walk(schema, _named_type(field.type), selection.selection_set, fragments, variables,
+                                  field_age, sessions)
+            max_age = min(max_age, field_age)
+
+        if max_age is None:
+            return None
+    return max_age
+
+
+class ResponseCache():
+    def __init__(self, max_size: int = None, enabled: bool = None):
+        self.enabled = enabled if enabled is not None else os.getenv('RESPONSE_CACHE', '0') == '1'
+        self.max_size = max_size if max_size is not None else int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+        self._responses = OrderedDict()
+        self._by_session: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def plan(self, schema, data, query_data) -> Optional[CachePlan]:
+        """How to cache the response to one parsed /graphql request, or None when it must not be cached."""
+        if not self.enabled or not isinstance(data, dict):
+            return None
+        try:
+            params = get_graphql_params(data, query_data)
+            if not params.query:
+                return None
+            document = backend.document_from_string(schema, params.query)
+        except Exception:
+            # Let the view report bad requests
+            return None
+
+        if getattr(document, 'validation_errors', None):
+            # Invalid documents are reported by the view, not planned
+            return None
+        document_ast = document.document_ast
+        operations = [definition for definition in document_ast.definitions
+                      if isinstance(definition, ast.OperationDefinition)]
+        if params.operation_name is None and len(operations) != 1:
+            return None
+        operation = next((o for o in operations if params.operation_name is None
+                          or (o.name is not None and o.name.value == params.operation_name)), None)
+        if operation is None or operation.operation != 'query':
+            return None
+
+        fragments = {definition.name.value: definition for definition in document_ast.definitions
+                     if isinstance(definition, ast.FragmentDefinition)}
+        variables = params.variables or {}
+        sessions = set()
+        max_age = _walk(schema, schema.get_query_type(), operation.selection_set, fragments, variables,
+                        max(CACHE_HINTS.values()), sessions, root=True)
+        if max_age is None or max_age <= 0:
+            return None
+
+        key = hashlib.sha256(json.dumps([print_ast(document_ast), params.operation_name, variables],
+                                        sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return CachePlan(key, max_age, {session for session in sessions if session is not None})
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._drop(key)
+                return None
+            self._responses.move_to_end(key)
+            return entry[1]
+
+    def put(self, plan: CachePlan, body: bytes):
+        with self._lock:
+            self._responses[plan.key] = (time.monotonic() + plan.max_age, body, plan.sessions)
+            self._responses.move_to_end(plan.key)
+            for session in plan.sessions:
+                self._by_session.setdefault(session, set()).add(plan.key)
+            while len(self._responses) > self.max_size:
+                self._drop(next(iter(self._responses)))
+
+    def _drop(self, key: str):
+        _, _, sessions = self._responses.pop(key)
+        for session in sessions:
+            keys = self._by_session.get(session)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._by_session[session]
+
+    def invalidate_session(self, session: str):
+        with self._lock:
+            for key in list(self._by_session.get(session, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+            self._by_session.clear()
+
+
+def cacheable_results(execution_results) -> bool:
+    """Whether a response may be cached, judged from its execution results rather than from the encoded body."""
+    return all(result is not None and not result.invalid and not result.errors for result in execution_results)
+
+
+responses = ResponseCache()
+catalog.add_listener(responses.clear)
+
+
+class CachingGraphQLView(PersistedQueryGraphQLView):
+    """
+    PersistedQueryGraphQLView serving read-only operations from the response cache and collecting metrics for every
+    request, with their extensions.tracing block when metrics.TRACING is on (traced responses are never cached).
+    """
+
+    def dispatch_request(self):
+        with metrics.collect():
+            return self.dispatch_cached_request()
+
+    def parse_body(self):
+        # The cache plan and the execution both need the body, so it is parsed once per request
+        if 'graphql_body' not in g:
+            g.graphql_body = super().parse_body()
+        return g.graphql_body
+
+    def encode(self, data, pretty=False):
+        # data is the formatted execution result, so whether it carries errors is known before it is serialized
+        g.graphql_cacheable = isinstance(data, dict) and 'errors' not in data
+        return json_encode(metrics.with_tracing(data), pretty)
+
+    def dispatch_cached_request(self):
+        if not responses.enabled or metrics.TRACING or request.args.get('pretty') or \
+                (request.method.lower() == 'get' and self.should_display_graphiql()):
+            return super().dispatch_request()
+        try:
+            plan = responses.plan(self.schema, self.parse_body(), request.args)
+        except HttpQueryError:
+            plan = None
+        if plan is None:
+            return super().dispatch_request()
+
+        body = responses.get(plan.key)
+        if body is not None:
+            return Response(body, status=200, content_type='application/json')
+
+        response = super().dispatch_request()
+        if response.status_code == 200 and g.get('graphql_cacheable', False):
+            responses.put(plan, response.get_data())
+        return response
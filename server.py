@@ -2,16 +2,16 @@ import os
 from json import dumps
 from flask import Flask, g, Response, request
 
-from neo4j import GraphDatabase, basic_auth
+from database import get_graph_db
 
 app = Flask(__name__)
 
-url = "bolt://localhost"
-password = 'memphis-place-optimal-velvet-phantom-127'
-
-driver = GraphDatabase.driver(url,auth=basic_auth("neo4j", password),encrypted=False)
-
 def get_db():
     if not hasattr(g, 'neo4j_db'):
-        g.neo4j_db = driver.session()
+        g.neo4j_db = get_graph_db().session()
     return g.neo4j_db
+
+@app.teardown_appcontext
+def close_db(error):
+    if hasattr(g, 'neo4j_db'):
+        get_graph_db().release(g.neo4j_db)
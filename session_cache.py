@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+"""
+In-process cache from session token to what the resolvers need to know about the account behind it: the node id
+(so statements can seek the node directly), its tag_* dietary flags and the recipes it made recently.
+
+Entries are written on login/account creation and dropped on logout/account deletion.  Other server processes do
+not see those events, so every statement matching by the cached id also checks a.session = $session and a stale id
+can only cost a failed match.  The cached tags and recent recipes can be stale too (SetDietaryRestrictions only
+updates the process that served it), so RequestMenu, their only reader, reads them from the graph again before
+planning.  SESSION_CACHE_TTL (seconds) and SESSION_CACHE_SIZE bound how long and how many sessions are kept.
+"""
+
+
+class SessionCache():
+    def __init__(self, ttl: float = None, max_size: int = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('SESSION_CACHE_TTL', 300))
+        self.max_size = max_size if max_size is not None else int(os.getenv('SESSION_CACHE_SIZE', 10000))
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._sessions.get(session)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._sessions[session]
+                return None
+            self._sessions.move_to_end(session)
+            return entry[1]
+
+    def put(self, session: str, account_id: int, tags: dict, recent_recipe_ids: Iterable[int] = ()) -> dict:
+        account = {'id': account_id, 'tags': dict(tags), 'recent_recipe_ids': list(recent_recipe_ids)}
+        with self._lock:
+            self._sessions[session] = (time.monotonic() + self.ttl, account)
+            self._sessions.move_to_end(session)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+        return account
+
+    def invalidate(self, session: str):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+
+sessions = SessionCache()
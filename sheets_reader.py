@@ -1,8 +1,33 @@
 import json
+import os
+import tempfile
+import threading
+import time
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
 
+"""
+Reads recipe data from the Google Sheets listed in sheet_directory.json.
+
+Header rows and grid sizes are cached per sheet for SHEET_HEADER_TTL seconds, shared by every reader in the process,
+and the reads that need several ranges ask for them in one values.batchGet.  Rows and columns are streamed
+SHEET_PAGE_SIZE rows per call up to the last row of the sheet's grid, so with a warm cache a sheet no bigger than a page
+costs one Sheets API call per read.  The grid size is only asked for again early when the data reaches its last row,
+in case the sheet grew.  Blank rows anywhere in the sheet never end a read early.
+
+SheetSnapshot keeps a whole sheet in memory and in SHEET_SNAPSHOT_DIR, keyed by the spreadsheet's Drive version.  The
+version is checked at most every SHEET_REVISION_CHECK_INTERVAL seconds and the sheet is only read again when it
+changed.  When Drive can't report a version the snapshot is refreshed every SHEET_SNAPSHOT_TTL seconds instead, and
+on every read that asks for a check.
+"""
+
+HEADER_TTL = float(os.getenv('SHEET_HEADER_TTL', 600))
+PAGE_SIZE = int(os.getenv('SHEET_PAGE_SIZE', 1000))
+SNAPSHOT_DIR = os.getenv('SHEET_SNAPSHOT_DIR', '.sheet_snapshots')
+REVISION_CHECK_INTERVAL = float(os.getenv('SHEET_REVISION_CHECK_INTERVAL', 30))
+SNAPSHOT_TTL = float(os.getenv('SHEET_SNAPSHOT_TTL', 300))
 
 letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
@@ -15,48 +40,318 @@ def sheet_index(row, col):
     column_index += letters[col % 26]
     return f'{column_index}{row + 1}'
 
+def column_letter(col):
+    return sheet_index(0, col)[:-1]
+
+
+class HeaderCache():
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._headers = {}
+        self._row_counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, sheet_id, sheet_name):
+        with self._lock:
+            entry = self._headers.get((sheet_id, sheet_name))
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            return entry[1]
+
+    def put(self, sheet_id, sheet_name, headers):
+        with self._lock:
+            self._headers[(sheet_id, sheet_name)] = (time.monotonic() + self.ttl, list(headers))
+
+    def get_row_count(self, sheet_id, sheet_name):
+        with self._lock:
+            entry = self._row_counts.get((sheet_id, sheet_name))
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            return entry[1]
+
+    def put_row_count(self, sheet_id, sheet_name, row_count):
+        with self._lock:
+            self._row_counts[(sheet_id, sheet_name)] = (time.monotonic() + self.ttl, row_count)
+
+    def invalidate(self, sheet_id=None, sheet_name=None):
+        with self._lock:
+            if sheet_id is None:
+                self._headers.clear()
+                self._row_counts.clear()
+            else:
+                self._headers.pop((sheet_id, sheet_name), None)
+                self._row_counts.pop((sheet_id, sheet_name), None)
+
+
+headers = HeaderCache(HEADER_TTL)
+
+
+def find_row(rows, column_name, value, source_name='sheet'):
+    """The first row below the header row whose column_name cell equals value, as a header -> cell dict."""
+    rows = iter(rows)
+    column_headers = next(rows, None)
+    if column_headers is None:
+        raise ValueError(f'{source_name} is empty')
+    column = column_headers.index(column_name)
+    for row in rows:
+        if column < len(row) and row[column] == value:
+            return {k: v for k, v in zip(column_headers, row)}
+    raise ValueError(f'No row in {source_name} with {column_name} {value}')
+
+
 class GoogleSheetsReader:
     def __init__(self, service_cred_file='.sheets_credentials.json', sheet_list_filename='sheet_directory.json'):
-        self.scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+        self.scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly',
+                       'https://www.googleapis.com/auth/drive.metadata.readonly']
         credentials = service_account.Credentials.from_service_account_file(service_cred_file, scopes=self.scopes)
         self.service = build('sheets', 'v4', credentials=credentials)
+        self.drive = build('drive', 'v3', credentials=credentials)
         with open(sheet_list_filename, 'r') as file:
             self.sheet_list = json.load(file)
 
-    def read_column(self, source_name, column_name):
+    def batch_get(self, source_name, ranges, major_dimension='ROWS'):
+        """Read several A1 ranges of a sheet (without the sheet name) in one call, a list of values per range."""
+        # pylint: disable=no-member
+        sheet_id = self.sheet_list[source_name]['sheet_id']
+        sheet_name = self.sheet_list[source_name]['sheet_name']
+        result = self.service.spreadsheets().values().batchGet(
+            spreadsheetId=sheet_id, ranges=[f'{sheet_name}!{a1_range}' for a1_range in ranges],
+            majorDimension=major_dimension).execute()
+        return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    def cached_headers(self, source_name):
+        return headers.get(**self.sheet_list[source_name])
+
+    def last_column(self, source_name):
+        """Letter of the last headed column, 'ZZZ' while the headers are unknown."""
+        column_headers = self.cached_headers(source_name)
+        if not column_headers:
+            return 'ZZZ'
+        return column_letter(len(column_headers) - 1)
+
+    def row_count(self, source_name):
+        """Rows in the sheet's grid, blank ones included, which is as far down as the data can reach."""
         # pylint: disable=no-member
-        headers = self.__read_row(**self.sheet_list[source_name], row_number=1)
-        column_indexes = {name:index for index, name in enumerate(headers)}
-        if column_name not in column_indexes:
-            return []
-        
-        sheet = self.service.spreadsheets() #py-lint ignore
-        id = self.sheet_list[source_name]['sheet_id']
-        name = self.sheet_list[source_name]['sheet_name']
-        column = column_indexes[column_name]
-        start_range = sheet_index(1, column)
-        end_range = sheet_index(1000, column)
-        result = sheet.values().get(spreadsheetId=id, majorDimension='COLUMNS', range=f'{name}!{start_range}:{end_range}').execute()
-
-        return result.get('values', [])[0]
+        sheet_id = self.sheet_list[source_name]['sheet_id']
+        sheet_name = self.sheet_list[source_name]['sheet_name']
+        result = self.service.spreadsheets().get(spreadsheetId=sheet_id, ranges=[sheet_name],
+                                                 fields='sheets(properties(gridProperties(rowCount)))').execute()
+        row_count = result['sheets'][0]['properties']['gridProperties']['rowCount']
+        headers.put_row_count(sheet_id, sheet_name, row_count)
+        return row_count
 
+    def last_row(self, source_name):
+        """The cached row count of the sheet's grid, asking for it only when it isn't cached."""
+        row_count = headers.get_row_count(**self.sheet_list[source_name])
+        return row_count if row_count is not None else self.row_count(source_name)
+
+    def iter_rows(self, source_name, start_row=1, page_size=None, last_row=None):
+        """
+        Yield the rows from start_row (1 is the header row) to the end of the grid, reading page_size rows per call.
+        Rows are yielded in place, [] for blank ones, apart from the blank rows at the very end of the sheet.
+        """
+        page_size = page_size or PAGE_SIZE
+        last_row = last_row or self.last_row(source_name)
+        row = start_row
+        while row <= last_row:
+            end = min(row + page_size - 1, last_row)
+            values = self.batch_get(source_name, [f'A{row}:{self.last_column(source_name)}{end}'])[0]
+            if row == 1 and len(values) > 0:
+                headers.put(**self.sheet_list[source_name], headers=values[0])
+            yield from values
+            if end == last_row and len(values) == end - row + 1:
+                # The data reaches the last row of the grid, which may have grown since its size was cached
+                last_row = self.row_count(source_name)
+            if end < last_row:
+                # The Sheets API leaves out the trailing empty rows of each range, keep the next page's rows in place
+                yield from ([] for _ in range(end - row + 1 - len(values)))
+            row = end + 1
+
+    def iter_columns(self, source_name, column_names, page_size=None):
+        """
+        Yield a tuple of the named columns' cells ('' for empty cells and unknown columns) for every row below the
+        header row, reading page_size rows of just those columns per call.
+        """
+        page_size = page_size or PAGE_SIZE
+        last_row = self.last_row(source_name)
+        row = 2
+        column_headers = self.cached_headers(source_name)
+        if column_headers is None:
+            # Without the headers we can't tell where the columns are, so the first page reads whole rows
+            rows = self.iter_rows(source_name, 1, page_size, last_row)
+            column_headers = next(rows, [])
+            indexes = [column_headers.index(name) if name in column_headers else None for name in column_names]
+            for count, values in enumerate(rows, 2):
+                yield tuple(values[index] if index is not None and index < len(values) else '' for index in indexes)
+                if count == page_size:
+                    break
+            else:
+                return
+            row = page_size + 1
+            last_row = self.last_row(source_name)
+        else:
+            indexes = [column_headers.index(name) if name in column_headers else None for name in column_names]
+
+        wanted = [index for index in indexes if index is not None]
+        if len(wanted) == 0:
+            return
+        while row <= last_row:
+            end = min(row + page_size - 1, last_row)
+            ranges = [f'{column_letter(index)}{row}:{column_letter(index)}{end}' for index in wanted]
+            columns = [values[0] if len(values) > 0 else []
+                       for values in self.batch_get(source_name, ranges, major_dimension='COLUMNS')]
+            by_index = dict(zip(wanted, columns))
+            length = max(len(column) for column in columns)
+            if end == last_row and length == end - row + 1:
+                # The data reaches the last row of the grid, which may have grown since its size was cached
+                last_row = self.row_count(source_name)
+            if end < last_row:
+                # Columns come back without their trailing empty cells, so every page but the last is padded to full length
+                length = end - row + 1
+            for offset in range(length):
+                yield tuple(by_index[index][offset] if index is not None and offset < len(by_index[index]) else ''
+                            for index in indexes)
+            row = end + 1
+
+    def read_columns(self, source_name, column_names):
+        """The values below the header row of each named column, by name ([] for unknown columns)."""
+        results = {name: [] for name in column_names}
+        for cells in self.iter_columns(source_name, column_names):
+            for name, cell in zip(column_names, cells):
+                results[name].append(cell)
+        for values in results.values():
+            while len(values) > 0 and values[-1] == '':
+                values.pop()
+        return results
+
+    def read_column(self, source_name, column_name):
+        return self.read_columns(source_name, [column_name])[column_name]
+
+    def read_all(self, source_name):
+        """Every row of the sheet, the header row first."""
+        return list(self.iter_rows(source_name))
+
+    def find_row(self, source_name, column_name, value):
+        """The first row whose column_name cell equals value as a header -> cell dict, reading only up to it."""
+        return find_row(self.iter_rows(source_name), column_name, value, source_name)
+
+    def revision(self, source_name):
+        """The spreadsheet's Drive version, None when Drive won't tell (e.g. the Drive API is not enabled)."""
+        # pylint: disable=no-member
+        try:
+            result = self.drive.files().get(fileId=self.sheet_list[source_name]['sheet_id'], fields='version').execute()
+        except HttpError:
+            return None
+        return result.get('version')
 
     def read_row_from_source(self, source_name, row_number, as_dict=False):
-        # print(self.sheet_list[source_name])
         if as_dict:
-            headers = self.__read_row(**self.sheet_list[source_name], row_number=1)
-            data = self.__read_row(**self.sheet_list[source_name], row_number=row_number)
-            return {k:v for k, v in zip(headers, data)}
+            column_headers = self.cached_headers(source_name)
+            if column_headers is None:
+                header_rows, data = self.batch_get(source_name, ['1:1', f'{row_number}:{row_number}'])
+                column_headers = header_rows[0] if len(header_rows) > 0 else []
+                headers.put(**self.sheet_list[source_name], headers=column_headers)
+                data = data[0] if len(data) > 0 else []
+            else:
+                data = self.__read_row(**self.sheet_list[source_name], row_number=row_number)
+            return {k:v for k, v in zip(column_headers, data)}
         return self.__read_row(**self.sheet_list[source_name], row_number=row_number)
 
     def __read_row(self, sheet_id, sheet_name, row_number):
         # pylint: disable=no-member
         sheet = self.service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=sheet_id, range=f'{sheet_name}!A{row_number}:ZZZ{row_number}').execute()
+        column_headers = headers.get(sheet_id, sheet_name)
+        last_column = column_letter(len(column_headers) - 1) if column_headers else 'ZZZ'
+        result = sheet.values().get(spreadsheetId=sheet_id,
+                                    range=f'{sheet_name}!A{row_number}:{last_column}{row_number}').execute()
         values = result.get('values', [])
         return values[0]
 
 
+class SheetSnapshot():
+    def __init__(self, reader: GoogleSheetsReader, source_name: str, directory: str = SNAPSHOT_DIR):
+        self.reader = reader
+        self.source_name = source_name
+        self.path = os.path.join(directory, f'{source_name}.json')
+        self.revision = None
+        self.rows = None
+        self._checked = None
+        self._fetched = None
+        # Held by the one thread talking to Drive and Sheets, never while serving rows
+        self._refresh_lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return
+        # Without a revision there is no telling how old the file is, so it only serves until the first check
+        self.revision = snapshot.get('revision')
+        self.rows = snapshot.get('rows')
+
+    def _save(self):
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # Every process writes its own temporary file, so workers saving at once never replace a half written one
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=f'{self.source_name}.', suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump({'revision': self.revision, 'rows': self.rows}, file, separators=(',', ':'))
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def _checked_recently(self, now):
+        return self.rows is not None and self._checked is not None and now - self._checked < REVISION_CHECK_INTERVAL
+
+    def get(self, check=False):
+        """
+        Every row of the sheet, the header row first; check=True asks for the revision even if asked recently.
+        While one thread refreshes, the others keep getting the current rows instead of waiting for it.
+        """
+        rows = self.rows
+        if not check and self._checked_recently(time.monotonic()):
+            return rows
+        if rows is not None and not check:
+            if not self._refresh_lock.acquire(blocking=False):
+                return rows
+        else:
+            self._refresh_lock.acquire()
+        try:
+            return self._refresh(check)
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self, check):
+        now = time.monotonic()
+        if not check and self._checked_recently(now):
+            # Refreshed by the thread this one waited for
+            return self.rows
+
+        revision = self.reader.revision(self.source_name)
+        self._checked = now
+        if self.rows is not None:
+            if revision is not None and revision == self.revision:
+                return self.rows
+            # Without a revision only a fresh read can tell a caller that asked to check that the rows are current
+            if revision is None and not check and self._fetched is not None and now - self._fetched < SNAPSHOT_TTL:
+                return self.rows
+
+        rows = self.reader.read_all(self.source_name)
+        self.revision = revision
+        self.rows = rows
+        self._fetched = now
+        self._save()
+        return rows
+
+    def find_row(self, column_name, value, check=False):
+        return find_row(self.get(check), column_name, value, self.source_name)
+
+
 def main():
     """Shows basic usage of the Sheets API.
     Prints values from a sample spreadsheet.
@@ -7,6 +7,7 @@ import tempfile
 import shutil
 import os
 from config import BUCKET
+import metrics
 from botocore.exceptions import ClientError
 
 
@@ -51,6 +52,7 @@ def compare_password(db_password, password):
 def upload_file(key: str, filename: str, bucket=BUCKET) -> Tuple[bool, str]:
     s3_client = boto3.client('s3')
     try:
+        metrics.record_s3_call('upload_file')
         response = s3_client.upload_file(filename, bucket, key)
     except ClientError as e:
         print(e)
@@ -64,6 +66,7 @@ def upload_object(key: str, content: str, tags="", bucket: str = BUCKET) -> Tupl
     #     tag_param = "&".join([f'key{i + 1}={tag}' for i, tag in enumerate(tags)])
     s3_client = boto3.client('s3')
     try:
+        metrics.record_s3_call('put_object')
         response = s3_client.put_object(Key=key, Bucket=bucket, Body=content, Tagging="&".join(tags))
     except ClientError as e:
         print(e)
@@ -73,6 +76,7 @@ def upload_object(key: str, content: str, tags="", bucket: str = BUCKET) -> Tupl
 
 def test_get_object():
     s3_client = boto3.client('s3')
+    metrics.record_s3_call('get_object')
     obj = s3_client.get_object(Bucket=BUCKET, Key="test_object")
     print(obj['Body'].read().decode('utf-8'))
 
@@ -111,6 +115,7 @@ def presign_object(key: str, request_type='get_object'):
     s3_client = boto3.client('s3')
     print("trying to request a presigned url for test_object")
     try:
+        metrics.record_s3_call('generate_presigned_url')
         response = s3_client.generate_presigned_url(request_type,
                                                     Params={'Bucket': BUCKET,
                                                             'Key': key},